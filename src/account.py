@@ -1,17 +1,25 @@
+import time
+from collections import OrderedDict
+from contextlib import suppress
 from pathlib import Path
 from typing import List, Dict, Any, Optional
 
 from PyQt6 import QtCore, QtGui
-from PyQt6.QtWidgets import QMainWindow, QMessageBox, QInputDialog, QStackedLayout, QLabel, QMenu
+from PyQt6.QtWidgets import QMainWindow, QMessageBox, QInputDialog, QStackedLayout, QLabel, QMenu, QApplication
 from mvclib import PublicKey
 from mvclib.constants import BIP44_DERIVATION_PATH
 from mvclib.hd import mnemonic_from_entropy, Xprv
 
 from base import require_password, select_chain, font, activate, set_password
+from cache import UnspentCache, KeyCache
+from contract import contract
 from designer.account import Ui_mainWindowAccount
+from discovery import GAP_LIMIT
 from hd import HdUi, Mode
 from input_dialog import InputDialogUi
 from key import KeyUi
+from payout import PayoutPlans
+from scheduler import RefreshScheduler
 from utils import write_account_file, xprv_valid, xpub_valid, wif_valid, address_valid, pk_valid
 from wallet import WalletUi
 
@@ -42,6 +50,9 @@ class WalletModel(QtCore.QAbstractListModel):
 
 class AccountUi(QMainWindow, Ui_mainWindowAccount):
     app_settings_updated = QtCore.pyqtSignal(object)
+    # wallet widgets are built the first time they are selected, and evicted when there are too many or unused for a while
+    wallet_widget_capacity = 8
+    wallet_widget_idle_seconds = 10 * 60
 
     def __init__(self, app_settings: Dict, account: List[Dict], account_file: str, password: str):
         super(AccountUi, self).__init__()
@@ -51,11 +62,22 @@ class AccountUi(QMainWindow, Ui_mainWindowAccount):
         self.account = account
         self.account_file = account_file
         self.password = password
+        self.unspent_cache = UnspentCache(str(Path(self.account_file).with_suffix('.cache')))
+        self.key_cache = KeyCache(str(Path(self.account_file).with_suffix('.keys')), self.password)
+        self.payout_plans = PayoutPlans(str(Path(self.account_file).with_suffix('.payouts')), self.password)
+        self.scheduler = RefreshScheduler()
 
         self.setWindowTitle(f'Account / {Path(self.account_file).stem}')
         self.setWindowState(QtCore.Qt.WindowState.WindowMaximized)
         self.stacked_layout = QStackedLayout()
         self.widget.setLayout(self.stacked_layout)
+        # account index -> wallet widget, in the order of the least recently used first
+        self.wallet_widgets: OrderedDict[int, WalletUi] = OrderedDict()
+        self.wallet_widgets_used: Dict[int, float] = {}
+        self.wallet_widget_evict_timer = QtCore.QTimer(self)
+        # noinspection PyUnresolvedReferences
+        self.wallet_widget_evict_timer.timeout.connect(self.evict_idle_wallet_widgets)
+        self.wallet_widget_evict_timer.start(60 * 1000)
 
         self.actionActivate.triggered.connect(lambda: activate(self.update_client_key))
         self.actionChangePassword.triggered.connect(lambda: require_password(self, set_password, self.password, slot=self.change_password))
@@ -68,28 +90,45 @@ class AccountUi(QMainWindow, Ui_mainWindowAccount):
         self.network_status = QLabel()
         self.statusbar.addWidget(self.network_status)
 
-        for i in range(len(self.account)):
-            self.add_wallet_widget(self.account[i], i)
-
         self.model = WalletModel(self.account)
         self.listViewWallets.setModel(self.model)
         self.listViewWallets.selectionModel().selectionChanged.connect(self.wallet_list_selection_changed)
         self.listViewWallets.setContextMenuPolicy(QtCore.Qt.ContextMenuPolicy.CustomContextMenu)
         self.listViewWallets.customContextMenuRequested.connect(self.wallet_list_context_menu)
         self.select_wallet_in_list(0)
+        # load the contract engine once the window is up, so that FT operations do not wait for it
+        QtCore.QTimer.singleShot(0, contract)
+
+    def refresh_wallets(self):
+        """Refresh the visible wallet first, and the others in background"""
+        for w in self.wallet_widgets.values():
+            w.refresh(RefreshScheduler.Visible if w is self.stacked_layout.currentWidget() else RefreshScheduler.Background)
 
     def update_client_key(self, client_key: str):
         self.app_settings['client_key'] = client_key
         self.app_settings_updated.emit(self.app_settings)
-        for i in range(self.stacked_layout.count()):
-            w: WalletUi = self.stacked_layout.widget(i)
+        self.scheduler.cancel_all()
+        for w in self.wallet_widgets.values():
             w.update_fields(app_settings=self.app_settings)
+        self.refresh_wallets()
 
     def change_password(self, password: str):
+        # interrupted payouts are re-encrypted first, they cannot be resumed if they are left under the old password
+        try:
+            self.payout_plans.update_fields(password)
+        except OSError as e:
+            QMessageBox.critical(self, 'Critical', f'The password was not changed, the interrupted payouts cannot be saved.\n\n{e}', QMessageBox.StandardButton.Ok)
+            return
+        try:
+            write_account_file(self.account, self.account_file, password)
+        except OSError as e:
+            with suppress(OSError):
+                self.payout_plans.update_fields(self.password)
+            QMessageBox.critical(self, 'Critical', f'The password was not changed, the account file cannot be saved.\n\n{e}', QMessageBox.StandardButton.Ok)
+            return
         self.password = password
-        write_account_file(self.account, self.account_file, self.password)
-        for i in range(self.stacked_layout.count()):
-            w: WalletUi = self.stacked_layout.widget(i)
+        self.key_cache.update_fields(self.password)
+        for w in self.wallet_widgets.values():
             w.update_fields(password=self.password)
         QMessageBox.information(self, 'Information', 'The password was changed successfully.', QMessageBox.StandardButton.Ok)
 
@@ -104,7 +143,10 @@ class AccountUi(QMainWindow, Ui_mainWindowAccount):
             # Update list selection
             self.listViewWallets.setCurrentIndex(self.model.index(index))
             # Display the corresponding widget
-            self.stacked_layout.setCurrentIndex(index)
+            w = self.wallet_widget(index)
+            self.stacked_layout.setCurrentWidget(w)
+            w.promote_refresh()
+            self.evict_wallet_widgets()
 
     def new_wallet_clicked(self):
         chain = select_chain(self)
@@ -151,7 +193,7 @@ class AccountUi(QMainWindow, Ui_mainWindowAccount):
             self.add_key({'address': text})
 
     def add_hd(self, hd: Dict):
-        hd.update({'name': f'HD Wallet {len(self.account) + 1}', 'receive_index': 0, 'receive_limit': 150, 'change_limit': 50, })
+        hd.update({'name': f'HD Wallet {len(self.account) + 1}', 'receive_index': 0, 'receive_limit': GAP_LIMIT, 'change_limit': GAP_LIMIT, })
         self.add_wallet(hd)
 
     def add_key(self, key: Dict):
@@ -162,7 +204,6 @@ class AccountUi(QMainWindow, Ui_mainWindowAccount):
         self.account.append(wallet)
         write_account_file(self.account, self.account_file, self.password)
         self.refresh_wallet_list()
-        self.add_wallet_widget(wallet, len(self.account) - 1)
         self.select_wallet_in_list(-1)
 
     def refresh_wallet_list(self):
@@ -171,12 +212,45 @@ class AccountUi(QMainWindow, Ui_mainWindowAccount):
         # noinspection PyUnresolvedReferences
         self.model.layoutChanged.emit()
 
-    def add_wallet_widget(self, wallet: Dict, account_index: int):
-        """Add a wallet widget on the right side"""
-        w = WalletUi(self.app_settings, self.password, wallet, account_index)
-        w.wallet_updated.connect(self.wallet_updated)
-        w.network_status_updated.connect(self.network_status_updated)
-        self.stacked_layout.addWidget(w)
+    def wallet_widget(self, account_index: int) -> WalletUi:
+        """Get the wallet widget on the right side, build it if not yet"""
+        w = self.wallet_widgets.get(account_index)
+        if w is None:
+            w = WalletUi(self.app_settings, self.password, self.account[account_index], account_index, self.unspent_cache, self.key_cache, self.payout_plans, self.scheduler)
+            w.wallet_updated.connect(self.wallet_updated)
+            w.network_status_updated.connect(self.network_status_updated)
+            self.stacked_layout.addWidget(w)
+            self.wallet_widgets[account_index] = w
+            w.refresh(RefreshScheduler.Visible)
+        self.wallet_widgets.move_to_end(account_index)
+        self.wallet_widgets_used[account_index] = time.monotonic()
+        return w
+
+    def evict_wallet_widget(self, account_index: int):
+        w = self.wallet_widgets.pop(account_index)
+        self.wallet_widgets_used.pop(account_index)
+        w.close()
+        self.stacked_layout.removeWidget(w)
+        w.deleteLater()
+
+    def wallet_widget_evictable(self, w: WalletUi) -> bool:
+        """Wallet widget in sight or in use by a dialog cannot be evicted"""
+        keys_visible = w.keys_widget is not None and w.keys_widget.isVisible()
+        return w is not self.stacked_layout.currentWidget() and not keys_visible and QApplication.activeModalWidget() is None
+
+    def evict_wallet_widgets(self):
+        """Evict the least recently used wallet widgets beyond the capacity"""
+        for account_index, w in list(self.wallet_widgets.items()):
+            if len(self.wallet_widgets) <= AccountUi.wallet_widget_capacity:
+                break
+            if self.wallet_widget_evictable(w):
+                self.evict_wallet_widget(account_index)
+
+    def evict_idle_wallet_widgets(self):
+        deadline = time.monotonic() - AccountUi.wallet_widget_idle_seconds
+        for account_index, w in list(self.wallet_widgets.items()):
+            if self.wallet_widgets_used[account_index] < deadline and self.wallet_widget_evictable(w):
+                self.evict_wallet_widget(account_index)
 
     def wallet_updated(self, wallet: Dict, account_index: int):
         self.account[account_index] = wallet
@@ -189,8 +263,10 @@ class AccountUi(QMainWindow, Ui_mainWindowAccount):
         self.network_status.setStyleSheet(colors[connectivity])
 
     def closeEvent(self, a0: QtGui.QCloseEvent) -> None:
-        for i in range(self.stacked_layout.count()):
-            self.stacked_layout.widget(i).close()
+        for w in self.wallet_widgets.values():
+            w.close()
+        self.scheduler.shutdown()
+        self.unspent_cache.close()
         super().closeEvent(a0)
 
     def wallet_list_context_menu(self, pos):
@@ -216,8 +292,8 @@ class AccountUi(QMainWindow, Ui_mainWindowAccount):
         self.account[index]['name'] = name
         write_account_file(self.account, self.account_file, self.password)
         self.refresh_wallet_list()
-        wallet_widget: WalletUi = self.stacked_layout.widget(index)
-        wallet_widget.update_fields(w=self.account[index])
+        if index in self.wallet_widgets:
+            self.wallet_widgets[index].update_fields(w=self.account[index])
 
     def context_menu_action_information_clicked(self):
         w: Dict = self.account[self.listViewWallets.selectedIndexes()[0].row()]
@@ -1,5 +1,8 @@
-from typing import Optional, List, Any, Dict, Callable
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Optional, List, Any, Dict, Callable, Tuple, Union, Set, Hashable
 
+import numpy as np
 from PyQt6 import QtCore, QtGui
 from PyQt6.QtGui import QFont
 from PyQt6.QtWidgets import QInputDialog, QLineEdit, QApplication, QTableView, QHeaderView, QAbstractItemView, QMessageBox
@@ -9,7 +12,8 @@ from mvclib.constants import Chain
 
 from input_dialog import InputDialogUi
 from set_password import SetPasswordUi
-from utils import format_coin
+from store import UnspentStore
+from utils import format_coin, format_coins
 
 
 def require_password(_parent: QWidget, _callback: Callable, _password: Optional[str] = None, **kwargs):
@@ -31,6 +35,16 @@ def _require_password(_parent: QWidget, _callback: Callable, _text: str, _passwo
         QMessageBox.critical(_parent, 'Critical', 'The account password you entered is not correct.', QMessageBox.StandardButton.Ok)
 
 
+def show_message(parent: QWidget, icon: QMessageBox.Icon, title: str, text: str, finished: Optional[Callable] = None):
+    """Message box which does not block the caller, finished is called when it is closed"""
+    box = QMessageBox(icon, title, text, QMessageBox.StandardButton.Ok, parent)
+    box.setAttribute(QtCore.Qt.WidgetAttribute.WA_DeleteOnClose)
+    if finished:
+        # noinspection PyUnresolvedReferences
+        box.finished.connect(finished)
+    box.open()
+
+
 def set_password(slot: Callable):
     dialog = SetPasswordUi()
     dialog.password_set.connect(slot)
@@ -54,7 +68,9 @@ def select_chain(parent: QWidget) -> Optional[Chain]:
     return None
 
 
+@lru_cache(maxsize=None)
 def font(family: str, size: int) -> QFont:
+    """Fonts are shared, do not modify the returned one"""
     f = QFont()
     f.setFamily(family)
     f.setPointSize(size)
@@ -77,29 +93,52 @@ def set_table_view(t: QTableView):
     t.setSortingEnabled(True)
 
 
-class UnspentModel(QtCore.QAbstractTableModel):
-    def __init__(self, unspents: Optional[List[Unspent]] = None):
-        super(UnspentModel, self).__init__()
-        self.unspents: List[Unspent] = []
-        self._unspents: List[str] = []
-        self.update_fields(unspents)
-        self.headers = ['Height', 'Outpoint', 'Address', 'Amount']
-
-    def update_fields(self, unspents: Optional[List[Unspent]] = None):
-        self.unspents = unspents or []
-        self._unspents = [(str(u.height), f'{u.txid}:{u.vout}', u.address, format_coin(u.satoshi)) for u in self.unspents]
-        # noinspection PyUnresolvedReferences
-        self.layoutChanged.emit()
+def _row_ranges(rows: List[int]) -> List[Tuple[int, int]]:
+    """Group sorted rows into ranges of (first, last)"""
+    ranges: List[Tuple[int, int]] = []
+    for row in rows:
+        if ranges and ranges[-1][1] == row - 1:
+            ranges[-1] = (ranges[-1][0], row)
+        else:
+            ranges.append((row, row))
+    return ranges
+
+
+class LazyTableModel(QtCore.QAbstractTableModel):
+    """Rows are formatted when they are painted, and the recently painted ones are kept in a bounded cache"""
+    row_cache_capacity = 2000
+
+    def __init__(self, headers: List[str]):
+        super(LazyTableModel, self).__init__()
+        self.headers = headers
+        # row key -> formatted row, in least recently used order
+        self.row_cache: OrderedDict[Hashable, Tuple[str, ...]] = OrderedDict()
+
+    def row_key(self, row: int) -> Hashable:
+        """Identify the content of a row, rows of the same key are formatted the same"""
+        return row
+
+    def format_rows(self, row: int) -> Dict[Hashable, Tuple[str, ...]]:
+        """Format the row, and the neighbours which are cheaper to format together, by their row keys. Rows are blank by default"""
+        return {self.row_key(row): ('',) * len(self.headers)}
+
+    def row_fields(self, row: int) -> Tuple[str, ...]:
+        key = self.row_key(row)
+        fields = self.row_cache.get(key)
+        if fields is None:
+            self.row_cache.update(self.format_rows(row))
+            fields = self.row_cache[key]
+            while len(self.row_cache) > self.row_cache_capacity:
+                self.row_cache.popitem(last=False)
+        self.row_cache.move_to_end(key)
+        return fields
 
     def data(self, index: QtCore.QModelIndex, role: int = ...) -> Any:
         if role == QtCore.Qt.ItemDataRole.DisplayRole:
-            return self._unspents[index.row()][index.column()]
+            return self.row_fields(index.row())[index.column()]
         elif role == QtCore.Qt.ItemDataRole.FontRole:
             return font('Monaco', 13)
 
-    def rowCount(self, parent: QtCore.QModelIndex = ...) -> int:
-        return len(self._unspents)
-
     def columnCount(self, parent: QtCore.QModelIndex = ...) -> int:
         return len(self.headers)
 
@@ -108,60 +147,263 @@ class UnspentModel(QtCore.QAbstractTableModel):
             return self.headers[section]
         return super().headerData(section, orientation, role)
 
-    def sort(self, column: int, order: QtCore.Qt.SortOrder = ...) -> None:
-        self.unspents.sort(key=lambda x: UnspentModel.item_value(x, column), reverse=order == QtCore.Qt.SortOrder.DescendingOrder)
-        self.update_fields(self.unspents)
 
-    @classmethod
-    def item_value(cls, unspent: Unspent, column: int):
-        return [unspent.height, f'{unspent.txid}:{unspent.vout}', unspent.address, unspent.satoshi][column]
+class TableModel(LazyTableModel):
+    """
+    Rows of a source (list of items or columnar store) shown through a permutation of the source rows in the sorted order.
+    Refreshes are applied by the difference between the shown source and the new one, rows are inserted, removed and changed in place,
+    so that selection and scroll position survive.
+    Sorting argsorts the sort keys of the column, which are cached until the source changes.
+    Rows are handed to the view in batches as it scrolls, rows not fetched yet are sorted and updated without any signal.
+    """
+    # adding more rows than this appends them all and sorts once, instead of inserting them one by one
+    insert_threshold = 16
+    # more removed row ranges than this resets the model instead
+    range_threshold = 64
+    fetch_size = 256
+    # rows formatted together, columns of a block are formatted at once
+    block_size = 64
+
+    def __init__(self, headers: List[str], source: Any = None):
+        super(TableModel, self).__init__(headers)
+        self.source: Any = self.empty_source()
+        # row -> source row
+        self.order: np.ndarray = np.arange(0)
+        # rows [0, fetched) are known by the view
+        self.fetched: int = 0
+        self.sort_column: int = -1
+        self.sort_order: QtCore.Qt.SortOrder = QtCore.Qt.SortOrder.AscendingOrder
+        self.sort_keys_cache: Dict[int, np.ndarray] = {}
+        self.update_fields(source)
+
+    def empty_source(self) -> Any:
+        return []
+
+    def source_length(self, source: Any) -> int:
+        return len(source)
+
+    def match_rows(self, source: Any, rows: np.ndarray) -> np.ndarray:
+        """Rows in the new source of the same items as rows in the shown source, -1 for the items gone. By default no item is kept, all the rows are replaced"""
+        return np.full(len(rows), -1, dtype=np.int64)
+
+    def changed(self, source: Any, rows: np.ndarray, source_rows: np.ndarray) -> np.ndarray:
+        """Whether the shown items of rows changed in the new source at source_rows. By default every kept item is updated"""
+        return np.ones(len(rows), dtype=bool)
+
+    def source_sort_keys(self, column: int) -> np.ndarray:
+        """Key of every source row to sort by the column, in the source order by default"""
+        return np.arange(self.source_length(self.source))
+
+    def format_block(self, source_rows: np.ndarray) -> List[Tuple[str, ...]]:
+        return [('',) * len(self.headers) for _ in range(len(source_rows))]
+
+    def row_key(self, row: int) -> Hashable:
+        return int(self.order[row])
+
+    def format_rows(self, row: int) -> Dict[Hashable, Tuple[str, ...]]:
+        """Rows in the block of row, in the sorted order"""
+        row_start = row - row % TableModel.block_size
+        source_rows = self.order[row_start:row_start + TableModel.block_size]
+        return dict(zip(source_rows.tolist(), self.format_block(source_rows)))
+
+    def update_fields(self, source: Any = None):
+        source = source if source is not None else self.empty_source()
+        rows = self.match_rows(source, self.order)
+        removed = _row_ranges(np.flatnonzero(rows < 0).tolist())
+        if len(removed) > TableModel.range_threshold:
+            self.beginResetModel()
+            self.source, self.order, self.fetched = source, np.arange(self.source_length(source)), 0
+            self.sort_keys_cache = {}
+            self.row_cache.clear()
+            self.endResetModel()
+            self.sort(self.sort_column, self.sort_order)
+            self.fetchMore(QtCore.QModelIndex())
+            return
+        for first, last in reversed(removed):
+            self.remove_rows(first, last)
+            rows = np.delete(rows, np.s_[first:last + 1])
+        changed = np.flatnonzero(self.changed(source, self.order, rows))
+        self.source, self.order = source, rows
+        self.sort_keys_cache = {}
+        self.row_cache.clear()
+        for first, last in _row_ranges(changed[changed < self.fetched].tolist()):
+            # noinspection PyUnresolvedReferences
+            self.dataChanged.emit(self.index(first, 0), self.index(last, len(self.headers) - 1))
+        if len(changed):
+            self.sort(self.sort_column, self.sort_order)
+        unshown = np.ones(self.source_length(source), dtype=bool)
+        unshown[rows] = False
+        added = np.flatnonzero(unshown)
+        if self.sort_column < 0 or len(added) > TableModel.insert_threshold:
+            if len(added):
+                self.order = np.concatenate([self.order, added])
+                self.sort(self.sort_column, self.sort_order)
+        else:
+            for source_row in added:
+                self.insert_row(source_row)
+        # views fetch more only when they scroll, hand them the first batch
+        if self.fetched < TableModel.fetch_size:
+            self.fetchMore(QtCore.QModelIndex())
+
+    def remove_rows(self, first: int, last: int):
+        if first < self.fetched:
+            self.beginRemoveRows(QtCore.QModelIndex(), first, min(last, self.fetched - 1))
+            self.order = np.delete(self.order, np.s_[first:last + 1])
+            self.fetched -= min(last, self.fetched - 1) - first + 1
+            self.endRemoveRows()
+        else:
+            self.order = np.delete(self.order, np.s_[first:last + 1])
+
+    def insert_row(self, source_row: int):
+        """Insert at the sorted position, after the equal ones"""
+        keys = self.sort_keys(self.sort_column)
+        shown_keys = keys[self.order]
+        if self.sort_order == QtCore.Qt.SortOrder.AscendingOrder:
+            position = int(np.searchsorted(shown_keys, keys[source_row], side='right'))
+        else:
+            position = len(shown_keys) - int(np.searchsorted(shown_keys[::-1], keys[source_row], side='left'))
+        # all the rows are known by the view, keep it that way
+        if position < self.fetched or self.fetched == len(self.order):
+            self.beginInsertRows(QtCore.QModelIndex(), position, position)
+            self.order = np.insert(self.order, position, source_row)
+            self.fetched += 1
+            self.endInsertRows()
+        else:
+            self.order = np.insert(self.order, position, source_row)
+
+    def sort_keys(self, column: int) -> np.ndarray:
+        if column not in self.sort_keys_cache:
+            self.sort_keys_cache[column] = self.source_sort_keys(column)
+        return self.sort_keys_cache[column]
+
+    def source_rows(self, rows: Set[int]) -> np.ndarray:
+        return self.order[sorted(rows)]
 
-
-class FtModel(QtCore.QAbstractTableModel):
-    def __init__(self, fts: Optional[List[Dict]] = None):
-        super(FtModel, self).__init__()
-        self.fts: List[Dict] = []
-        self._fts: List[str] = []
-        self.update_fields(fts)
-        self.headers = ['Symbol', 'Name', 'Identifier', 'UTXO', 'Amount']
-
-    def update_fields(self, fts: Optional[List[Dict]] = None):
-        self.fts = fts or []
-        self._fts = []
-        for i in range(len(self.fts)):
-            ft = fts[i]
-            token_id = f'{ft["codeHash"]}/{ft["genesis"]}'
-            amount = int(ft['confirmedString']) + int(ft['unconfirmedString'])
-            self._fts.append((ft['symbol'], ft['name'], token_id, str(ft['utxoCount']), format_coin(amount, ft['decimal'])))
+    def rowCount(self, parent: QtCore.QModelIndex = ...) -> int:
+        return self.fetched
+
+    def canFetchMore(self, parent: QtCore.QModelIndex) -> bool:
+        return self.fetched < len(self.order)
+
+    def fetchMore(self, parent: QtCore.QModelIndex) -> None:
+        self.fetch(TableModel.fetch_size)
+
+    def fetch(self, count: int):
+        count = min(count, len(self.order) - self.fetched)
+        if count > 0:
+            self.beginInsertRows(QtCore.QModelIndex(), self.fetched, self.fetched + count - 1)
+            self.fetched += count
+            self.endInsertRows()
+
+    def sort(self, column: int, order: QtCore.Qt.SortOrder = QtCore.Qt.SortOrder.AscendingOrder) -> None:
+        """Reorder the permutation only, cells are not formatted again"""
+        self.sort_column, self.sort_order = column, order
+        if column < 0:
+            return
+        keys = self.sort_keys(column)[self.order]
+        if order == QtCore.Qt.SortOrder.AscendingOrder:
+            permutation = np.argsort(keys, kind='stable')
+        else:
+            permutation = len(keys) - 1 - np.argsort(keys[::-1], kind='stable')[::-1]
+        if np.array_equal(permutation, np.arange(len(keys))):
+            return
+        rows = np.empty(len(permutation), dtype=np.int64)
+        rows[permutation] = np.arange(len(permutation))
+        # selected rows might be moved beyond the fetched ones, fetch them first
+        self.fetch(max([int(rows[index.row()]) + 1 for index in self.persistentIndexList()], default=0) - self.fetched)
+        # noinspection PyUnresolvedReferences
+        self.layoutAboutToBeChanged.emit()
+        self.order = self.order[permutation]
+        persistent_indexes = self.persistentIndexList()
+        self.changePersistentIndexList(persistent_indexes, [self.index(int(rows[index.row()]), index.column()) for index in persistent_indexes])
         # noinspection PyUnresolvedReferences
         self.layoutChanged.emit()
 
-    def data(self, index: QtCore.QModelIndex, role: int = ...) -> Any:
-        if role == QtCore.Qt.ItemDataRole.DisplayRole:
-            return self._fts[index.row()][index.column()]
-        elif role == QtCore.Qt.ItemDataRole.FontRole:
-            return font('Monaco', 13)
 
-    def rowCount(self, parent: QtCore.QModelIndex = ...) -> int:
-        return len(self._fts)
+class UnspentModel(TableModel):
+    """Unspents in a columnar store"""
 
-    def columnCount(self, parent: QtCore.QModelIndex = ...) -> int:
-        return len(self.headers)
+    def __init__(self, unspents: Union[UnspentStore, List[Unspent], None] = None):
+        super(UnspentModel, self).__init__(['Height', 'Outpoint', 'Address', 'Amount'], unspents)
 
-    def headerData(self, section: int, orientation: QtCore.Qt.Orientation, role: int = ...) -> Any:
-        if role == QtCore.Qt.ItemDataRole.DisplayRole and orientation == QtCore.Qt.Orientation.Horizontal:
-            return self.headers[section]
-        return super().headerData(section, orientation, role)
+    @property
+    def store(self) -> UnspentStore:
+        return self.source
+
+    def empty_source(self) -> UnspentStore:
+        return UnspentStore.empty()
+
+    def source_length(self, source: UnspentStore) -> int:
+        return len(source)
+
+    def update_fields(self, unspents: Union[UnspentStore, List[Unspent], None] = None):
+        super(UnspentModel, self).update_fields(unspents if isinstance(unspents, UnspentStore) else UnspentStore.from_unspents(unspents or []))
 
-    def sort(self, column: int, order: QtCore.Qt.SortOrder = ...) -> None:
-        self.fts.sort(key=lambda x: FtModel.item_value(x, column), reverse=order == QtCore.Qt.SortOrder.DescendingOrder)
-        self.update_fields(self.fts)
+    def match_rows(self, store: UnspentStore, rows: np.ndarray) -> np.ndarray:
+        outpoints = self.store.outpoints[rows]
+        if not len(store):
+            return np.full(len(rows), -1, dtype=np.int64)
+        sorter = np.argsort(store.outpoints)
+        found = sorter[np.minimum(np.searchsorted(store.outpoints, outpoints, sorter=sorter), len(store) - 1)]
+        return np.where(store.outpoints[found] == outpoints, found, -1)
+
+    def changed(self, store: UnspentStore, rows: np.ndarray, source_rows: np.ndarray) -> np.ndarray:
+        return (self.store.heights[rows] != store.heights[source_rows]) | (self.store.satoshis[rows] != store.satoshis[source_rows])
+
+    def source_sort_keys(self, column: int) -> np.ndarray:
+        if column == 0:
+            return self.store.heights
+        elif column == 1:
+            return self.store.outpoints
+        elif column == 2:
+            return np.array(self.store.addresses)[self.store.address_ids] if len(self.store) else np.empty(0, dtype=str)
+        return self.store.satoshis
+
+    def format_block(self, source_rows: np.ndarray) -> List[Tuple[str, ...]]:
+        heights, vouts, amounts = self.store.heights[source_rows].tolist(), self.store.vouts[source_rows].tolist(), format_coins(self.store.satoshis[source_rows])
+        return [(str(heights[i]), f'{self.store.txid(source_row)}:{vouts[i]}', self.store.address(source_row), amounts[i]) for i, source_row in enumerate(source_rows.tolist())]
+
+
+class FtModel(TableModel):
+    def __init__(self, fts: Optional[List[Dict]] = None):
+        super(FtModel, self).__init__(['Symbol', 'Name', 'Identifier', 'UTXO', 'Amount'], fts)
+
+    @property
+    def fts(self) -> List[Dict]:
+        return self.source
+
+    def empty_source(self) -> List[Dict]:
+        return []
+
+    def source_length(self, fts: List[Dict]) -> int:
+        return len(fts)
+
+    @classmethod
+    def item_key(cls, ft: Dict) -> Tuple[str, str]:
+        return ft['codeHash'], ft['genesis']
 
     @classmethod
-    def item_value(cls, ft: Dict, column: int):
-        if column < 4:
-            return [ft['symbol'], ft['name'], f'{ft["codeHash"]}/{ft["genesis"]}', ft['utxoCount']][column]
-        return int(ft['confirmedString']) + int(ft['unconfirmedString'])
+    def item_values(cls, ft: Dict) -> Tuple:
+        return ft['symbol'], ft['name'], f'{ft["codeHash"]}/{ft["genesis"]}', ft['utxoCount'], int(ft['confirmedString']) + int(ft['unconfirmedString'])
+
+    def match_rows(self, fts: List[Dict], rows: np.ndarray) -> np.ndarray:
+        refreshed = {FtModel.item_key(ft): i for i, ft in enumerate(fts)}
+        return np.array([refreshed.get(FtModel.item_key(self.fts[row]), -1) for row in rows], dtype=np.int64)
+
+    def changed(self, fts: List[Dict], rows: np.ndarray, source_rows: np.ndarray) -> np.ndarray:
+        return np.array([FtModel.item_values(self.fts[row]) != FtModel.item_values(fts[source_row]) for row, source_row in zip(rows, source_rows)], dtype=bool)
+
+    def source_sort_keys(self, column: int) -> np.ndarray:
+        # amounts of large decimal tokens overflow int64, they are sorted as python integers
+        keys = [FtModel.item_values(ft)[column] for ft in self.fts]
+        return np.array(keys, dtype=object if column == 4 else None)
+
+    def format_block(self, source_rows: np.ndarray) -> List[Tuple[str, ...]]:
+        rows: List[Tuple[str, ...]] = []
+        for source_row in source_rows.tolist():
+            symbol, name, token_id, utxo_count, amount = FtModel.item_values(self.fts[source_row])
+            rows.append((symbol, name, token_id, str(utxo_count), format_coin(amount, self.fts[source_row]['decimal'])))
+        return rows
 
 
 def copy_table_selected(t: QTableView, separator: str = ','):
@@ -174,5 +416,7 @@ def copy_table_selected(t: QTableView, separator: str = ','):
 
 
 def table_select_all(t: QTableView):
+    while t.model().canFetchMore(QtCore.QModelIndex()):
+        t.model().fetchMore(QtCore.QModelIndex())
     t.selectAll()
     t.setFocus()
@@ -0,0 +1,47 @@
+"""
+Benchmark of signing large consolidation transactions, in one thread and on the process pool.
+
+    python src/benchmark_sign.py [input count ...]
+"""
+import os
+import sys
+import time
+from multiprocessing import freeze_support
+from typing import List
+
+from mvclib import Key, Unspent, Transaction
+from mvclib.constants import Chain
+
+from derivation import executor
+from sender import sign_transaction
+
+INPUT_COUNTS = [1000, 5000, 20000]
+
+
+def consolidation(key: Key, count: int) -> Transaction:
+    unspents = [Unspent(txid=f'{i:064x}', vout=0, satoshi=10000, height=1, address=key.address(), private_keys=[key]) for i in range(count)]
+    return Transaction(chain=Chain.TEST).add_inputs(unspents).add_change(key.address())
+
+
+def timed_sign(t: Transaction, parallel: bool) -> float:
+    start = time.perf_counter()
+    sign_transaction(t, parallel=parallel)
+    return time.perf_counter() - start
+
+
+def main(counts: List[int]):
+    key = Key(chain=Chain.TEST)
+    # start the workers before timing
+    executor().submit(int).result()
+    print(f'{os.cpu_count()} CPU(s)')
+    print(f'{"inputs":>8} {"serial":>10} {"parallel":>10} {"speedup":>8}')
+    for count in counts:
+        serial_transaction, parallel_transaction = consolidation(key, count), consolidation(key, count)
+        serial, parallel = timed_sign(serial_transaction, False), timed_sign(parallel_transaction, True)
+        assert serial_transaction.hex() == parallel_transaction.hex()
+        print(f'{count:>8} {serial:>9.3f}s {parallel:>9.3f}s {serial / parallel:>7.2f}x')
+
+
+if __name__ == '__main__':
+    freeze_support()
+    main([int(arg) for arg in sys.argv[1:]] or INPUT_COUNTS)
@@ -0,0 +1,134 @@
+import sqlite3
+from contextlib import suppress
+from typing import List, Tuple, Dict
+
+import numpy as np
+from mvclib.constants import Chain
+from mvclib.hash import sha256, hash160
+from mvclib.hd import Xpub
+
+from derivation import DerivedKey, derive_keys
+from store import UnspentStore
+from utils import encrypt_json, decrypt_json
+
+
+def wallet_key(identifier: str) -> str:
+    """Identify a wallet in the caches by the hash of its xpub or address, a key of fixed length"""
+    return sha256(identifier.encode('utf-8')).hex()
+
+
+class UnspentCache:
+    """
+    Last-known unspents of every wallet in the account, used to show a wallet before the network refresh finishes.
+    Unspents are public chain data and are stored in plain, addresses included.
+    """
+
+    def __init__(self, file: str):
+        self.connection = sqlite3.connect(file)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS unspent (
+                wallet TEXT NOT NULL,
+                chain TEXT NOT NULL,
+                txid TEXT NOT NULL,
+                vout INTEGER NOT NULL,
+                satoshi INTEGER NOT NULL,
+                height INTEGER NOT NULL,
+                address TEXT NOT NULL,
+                PRIMARY KEY (wallet, chain, txid, vout)
+            )
+        ''')
+        self.connection.commit()
+        # (wallet, chain) -> unspents as they are in the cache, once loaded or merged
+        self.stored: Dict[Tuple[str, str], UnspentStore] = {}
+
+    def load(self, wallet: str, chain: Chain) -> UnspentStore:
+        """Unspents in the cache have no key paths, they are for display only"""
+        store = UnspentStore.empty()
+        with suppress(Exception):
+            rows = self.connection.execute('SELECT txid, vout, satoshi, height, address FROM unspent WHERE wallet = ? AND chain = ?', (wallet, chain.value))
+            store = UnspentStore.from_dicts([{'txid': row[0], 'vout': row[1], 'satoshi': row[2], 'height': row[3], 'address': row[4]} for row in rows])
+            self.stored[(wallet, chain.value)] = store
+        return store
+
+    def merge(self, wallet: str, chain: Chain, store: UnspentStore) -> Tuple[int, int]:
+        """
+        Write the difference between the cache and the refreshed unspents only, returns (added, removed).
+        The difference is taken on the outpoint arrays against the unspents last loaded or merged, so that only the rows written are materialized.
+        The cache is best effort, nothing is written if it fails.
+        """
+        with suppress(Exception):
+            cached = self.stored.get((wallet, chain.value))
+            if cached is None:
+                cached = self.load(wallet, chain)
+            kept = np.isin(store.outpoints, cached.outpoints)
+            added = np.flatnonzero(~kept)
+            removed = np.flatnonzero(~np.isin(cached.outpoints, store.outpoints))
+            kept_rows = np.flatnonzero(kept)
+            sorter = np.argsort(cached.outpoints)
+            cached_rows = sorter[np.searchsorted(cached.outpoints, store.outpoints[kept_rows], sorter=sorter)]
+            confirmed = kept_rows[store.heights[kept_rows] != cached.heights[cached_rows]]
+            with self.connection:
+                self.connection.executemany('DELETE FROM unspent WHERE wallet = ? AND chain = ? AND txid = ? AND vout = ?',
+                                            [(wallet, chain.value, cached.txid(row), int(cached.vouts[row])) for row in removed])
+                self.connection.executemany('INSERT INTO unspent VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                            [(wallet, chain.value, store.txid(row), int(store.vouts[row]), int(store.satoshis[row]), int(store.heights[row]), store.address(row))
+                                             for row in added])
+                self.connection.executemany('UPDATE unspent SET height = ? WHERE wallet = ? AND chain = ? AND txid = ? AND vout = ?',
+                                            [(int(store.heights[row]), wallet, chain.value, store.txid(row), int(store.vouts[row])) for row in confirmed])
+            self.stored[(wallet, chain.value)] = store
+            return len(added), len(removed)
+        return 0, 0
+
+    def close(self):
+        self.connection.close()
+
+
+class KeyCache:
+    """Derived public keys of the HD wallets in the account, encrypted by the account password"""
+
+    def __init__(self, file: str, password: str):
+        self.file = file
+        self.password = password
+        # wallet key -> {'fingerprint': str, '0': receive keys, '1': change keys}
+        self.wallets: Dict[str, Dict] = {}
+        with suppress(Exception):
+            with open(self.file, 'rb') as f:
+                self.wallets = decrypt_json(f.read(), self.password)
+
+    def wallet(self, xpub: Xpub) -> Dict:
+        key = wallet_key(str(xpub))
+        fingerprint = hash160(xpub.key_bytes)[:4].hex()
+        wallet = self.wallets.get(key)
+        if wallet is None or wallet.get('fingerprint') != fingerprint:
+            wallet = {'fingerprint': fingerprint, '0': [], '1': []}
+            self.wallets[key] = wallet
+        return wallet
+
+    def cached(self, xpub: Xpub, change: int, index_end: int) -> List[DerivedKey]:
+        """Keys in range [0, index_end) which are in the cache already, the rest are derived by the caller"""
+        return [DerivedKey(*k) for k in self.wallet(xpub)[str(change)][:index_end]]
+
+    def extend(self, xpub: Xpub, change: int, index_start: int, keys: List[DerivedKey]):
+        """Append keys derived from index_start, keys not following the cached ones are ignored"""
+        cached = self.wallet(xpub)[str(change)]
+        if index_start <= len(cached) < index_start + len(keys):
+            cached.extend([list(k) for k in keys[len(cached) - index_start:]])
+
+    def keys(self, xpub: Xpub, change: int, index_start: int, index_end: int) -> List[DerivedKey]:
+        """Keys in range [index_start, index_end), those not in the cache are derived but not cached"""
+        keys = [DerivedKey(*k) for k in self.wallet(xpub)[str(change)][index_start:index_end]]
+        if index_start + len(keys) < index_end:
+            keys.extend(derive_keys(xpub, index_start + len(keys), index_end, change))
+        return keys
+
+    def key(self, xpub: Xpub, change: int, index: int) -> DerivedKey:
+        return self.keys(xpub, change, index, index + 1)[0]
+
+    def update_fields(self, password: str):
+        self.password = password
+        self.save()
+
+    def save(self):
+        with suppress(Exception):
+            with open(self.file, 'wb') as f:
+                f.write(encrypt_json(self.wallets, self.password))
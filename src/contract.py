@@ -4,9 +4,11 @@ import os
 import re
 import sys
 import uuid
-from typing import Callable, Any
+from collections import OrderedDict
+from typing import Callable, Any, Optional
 from typing import List, Dict
 
+from PyQt6 import QtCore
 from PyQt6.QtCore import QFile, QByteArray, QIODevice, pyqtSlot, qInstallMessageHandler
 from PyQt6.QtWebChannel import QWebChannel
 from PyQt6.QtWebEngineCore import QWebEngineProfile, QWebEngineUrlSchemeHandler, QWebEngineUrlScheme
@@ -16,6 +18,23 @@ from mvclib.constants import Chain
 
 basedir = os.path.abspath(os.path.dirname(sys.argv[0]))
 
+_scheme = QByteArray(b'local-file')
+_scheme_registered = False
+_contract: Optional['Contract'] = None
+
+# result code of a request without response before its deadline
+CODE_TIMEOUT = -408
+# seconds to wait for the response of an FT transfer, merging FT UTXOs before it takes a while
+FT_TRANSFER_TIMEOUT = 180
+
+
+def register_scheme():
+    """Register the scheme of contract files once, which Qt expects before the application is created"""
+    global _scheme_registered
+    if not _scheme_registered:
+        QWebEngineUrlScheme.registerScheme(QWebEngineUrlScheme(_scheme))
+        _scheme_registered = True
+
 
 class UrlSchemeHandler(QWebEngineUrlSchemeHandler):
 
@@ -32,15 +51,23 @@ class UrlSchemeHandler(QWebEngineUrlSchemeHandler):
 
 # https://github.com/PyQt5/PyQt/tree/master/QWebEngineView
 class ContractWebEngineView(QWebEngineView):
+    # request id, result
+    responded = QtCore.pyqtSignal(str, object)
+    # request id, progress
+    progressed = QtCore.pyqtSignal(str, object)
+
     def __init__(self):
         super(ContractWebEngineView, self).__init__()
 
-        self.callbacks = {}
+        # scripts run before the page is loaded wait for it
+        self.loaded = False
+        self.pending: List[str] = []
 
-        scheme = QByteArray(b'local-file')
-        QWebEngineUrlScheme.registerScheme(QWebEngineUrlScheme(scheme))
+        register_scheme()
         profile = QWebEngineProfile.defaultProfile()
-        profile.installUrlSchemeHandler(scheme, UrlSchemeHandler(self))
+        profile.installUrlSchemeHandler(_scheme, UrlSchemeHandler(self))
+        # noinspection PyUnresolvedReferences
+        self.loadFinished.connect(self.page_loaded)
         self.setHtml(open(os.path.join(basedir, os.path.join('contract', 'index.html')), 'r', encoding='utf-8').read())
 
         channel = QWebChannel(self)
@@ -49,28 +76,152 @@ class ContractWebEngineView(QWebEngineView):
         # https://stackoverflow.com/questions/58906917/warnings-when-instantiating-qwebchannel-object-in-javascript
         qInstallMessageHandler(lambda *args: None)
 
+    def page_loaded(self, ok: bool):
+        self.loaded = ok
+        if ok:
+            for script in self.pending:
+                self.page().runJavaScript(script)
+            self.pending.clear()
+
+    def run_script(self, script: str):
+        if self.loaded:
+            self.page().runJavaScript(script)
+        else:
+            self.pending.append(script)
+
     @pyqtSlot(str)
     def js_callback(self, s: str):
         r = json.loads(s)
-        if r['requestId'] in self.callbacks.keys():
-            func = self.callbacks.pop(r['requestId'])
-            func(r['result'])
+        self.responded.emit(r['requestId'], r['result'])
+
+    @pyqtSlot(str)
+    def js_progress(self, s: str):
+        r = json.loads(s)
+        self.progressed.emit(r['requestId'], r['progress'])
+
+
+class ContractBusy(Exception):
+    pass
+
+
+class ContractRequest:
+    """Contract operation submitted to the engine, waiting for its response until the deadline"""
+
+    def __init__(self, request_id: str, lane: str, script: str, callback: Callable[[Dict], Any], timeout: float, progress: Optional[Callable[[Dict], Any]] = None):
+        self.request_id = request_id
+        self.lane = lane
+        self.script = script
+        self.callback = callback
+        self.timeout = timeout
+        self.progress = progress
+        self.timer: Optional[QtCore.QTimer] = None
+        self.cancelled = False
+
+
+class RequestMultiplexer(QtCore.QObject):
+    """
+    Many contract operations over the one web channel of the engine, matched to their responses by the request id.
+    Requests of the same lane (the wallet spending) run one after another, since they spend the same UTXOs, and at most max_in_flight run at a time.
+    Requests beyond max_pending are refused, so that callers back off instead of queueing without bound.
+    A request without response before its deadline is answered by CODE_TIMEOUT, and its late response is dropped.
+    Progress reported by a request pushes its deadline back, since the operation is alive.
+    A request cancelled is never answered, but it keeps its lane busy until the engine responds or the deadline passes,
+    because the operation running in JS cannot be stopped.
+    """
+
+    def __init__(self, run_script: Callable[[str], None], max_in_flight: int = 4, max_pending: int = 32, parent: Optional[QtCore.QObject] = None):
+        super(RequestMultiplexer, self).__init__(parent)
+        self.run_script = run_script
+        self.max_in_flight = max_in_flight
+        self.max_pending = max_pending
+        self.queued: OrderedDict[str, ContractRequest] = OrderedDict()
+        self.in_flight: Dict[str, ContractRequest] = {}
+
+    def submit(self, function: str, params: Dict, callback: Callable[[Dict], Any], lane: str = '', timeout: float = FT_TRANSFER_TIMEOUT,
+               progress: Optional[Callable[[Dict], Any]] = None) -> str:
+        """
+        Call the JS function with params and the request id, callback is called with the result, and progress with the progress reported
+        :raises ContractBusy: too many requests pending
+        """
+        if len(self.queued) + len(self.in_flight) >= self.max_pending:
+            raise ContractBusy(f'{len(self.queued) + len(self.in_flight)} contract operations are pending, try again later.')
+        request_id = str(uuid.uuid4())
+        script = f'{function}({json.dumps({**params, "requestId": request_id})})'
+        self.queued[request_id] = ContractRequest(request_id, lane, script, callback, timeout, progress)
+        self.dispatch()
+        return request_id
+
+    def dispatch(self):
+        """Start the queued requests in order, skipping those of a busy lane"""
+        busy = {request.lane for request in self.in_flight.values()}
+        for request in list(self.queued.values()):
+            if len(self.in_flight) >= self.max_in_flight:
+                break
+            if request.lane in busy:
+                continue
+            del self.queued[request.request_id]
+            self.in_flight[request.request_id] = request
+            busy.add(request.lane)
+            request.timer = QtCore.QTimer(self)
+            request.timer.setSingleShot(True)
+            # noinspection PyUnresolvedReferences
+            request.timer.timeout.connect(lambda request_id=request.request_id: self.expire(request_id))
+            request.timer.start(int(request.timeout * 1000))
+            self.run_script(request.script)
+
+    def resolve(self, request_id: str, result: Dict):
+        request = self.finish(request_id)
+        if request and not request.cancelled:
+            request.callback(result)
+
+    def report(self, request_id: str, progress: Dict):
+        request = self.in_flight.get(request_id)
+        if request:
+            request.timer.start(int(request.timeout * 1000))
+            if request.progress and not request.cancelled:
+                request.progress(progress)
+
+    def expire(self, request_id: str):
+        request = self.finish(request_id)
+        if request and not request.cancelled:
+            request.callback({'code': CODE_TIMEOUT, 'message': f'No response in {request.timeout:g} seconds.'})
+
+    def cancel(self, request_id: str) -> bool:
+        """:returns: False if the request is running in the engine already, of which the operation might still complete"""
+        if request_id in self.queued:
+            del self.queued[request_id]
+            return True
+        if request_id in self.in_flight:
+            self.in_flight[request_id].cancelled = True
+        return False
+
+    def finish(self, request_id: str) -> Optional[ContractRequest]:
+        request = self.in_flight.pop(request_id, None)
+        if request:
+            request.timer.stop()
+            request.timer.deleteLater()
+            self.dispatch()
+        return request
 
 
 class Contract:
+    """Contract operations run by the JS library on a web engine, see contract() for the one shared by the process"""
 
     def __init__(self):
         self.engine = ContractWebEngineView()
-
-    def register_callback(self, callback: Callable) -> str:
-        request_id = str(uuid.uuid4())
-        self.engine.callbacks[request_id] = callback
-        return request_id
-
-    def ft_transfer(self, ft: Dict, key: Key, receivers: List[Dict], callback: Callable[[Dict], Any]):
-        request_id = self.register_callback(callback)
+        self.requests = RequestMultiplexer(self.engine.run_script, parent=self.engine)
+        self.engine.responded.connect(self.requests.resolve)
+        self.engine.progressed.connect(self.requests.report)
+
+    def ft_transfer(self, ft: Dict, key: Key, receivers: List[Dict], callback: Callable[[Dict], Any], timeout: float = FT_TRANSFER_TIMEOUT,
+                    progress: Optional[Callable[[Dict], Any]] = None) -> str:
+        """
+        FT UTXOs are merged as planned by the JS on the UTXOs held, before the transfer
+        :param progress: called with {'stage': 'merge' or 'transfer', 'done': int, 'total': int}
+        :returns: request id to cancel
+        :raises ContractBusy:
+        """
         params = {
-            'requestId': request_id,
             'network': 'mainnet' if key.chain == Chain.MAIN else 'testnet',
             'purse': key.wif(),
             'feeb': 1,
@@ -78,6 +229,20 @@ class Contract:
             'genesis': ft['genesis'],
             'receivers': receivers,
             'senderWif': key.wif(),
-            'utxoCount': ft['utxoCount'],
+            'senderAddress': key.address(),
         }
-        self.engine.page().runJavaScript(f'ftTransfer( {params})')
+        return self.requests.submit('ftTransfer', params, callback, key.address(), timeout, progress)
+
+    def cancel(self, request_id: str) -> bool:
+        return self.requests.cancel(request_id)
+
+
+def contract() -> Contract:
+    """
+    Contract engine shared by the process, created on the first call and kept warm,
+    so the JS library is loaded and parsed once instead of by every FT operation.
+    """
+    global _contract
+    if _contract is None:
+        _contract = Contract()
+    return _contract
@@ -1,20 +1,112 @@
-async function ftTransfer({requestId, network, purse, feeb, codehash, genesis, receivers, senderWif, utxoCount}) {
+// FT UTXOs merged into one by a merge transaction at most
+const MERGE_SIZE = 20
+
+// FT UTXOs a transfer to the receivers can spend at most, the contract grows with inputs times outputs
+function transferInputsLimit(receiverCount) {
+    if (receiverCount <= 5) {
+        return 20
+    } else if (receiverCount <= 12) {
+        return 8
+    }
+    return 3
+}
+
+// Merges of one round, and UTXOs merged by them, which leave no more than inputsLimit of count UTXOs,
+// or merge all of them when that is not enough
+function mergeRound(count, inputsLimit) {
+    const merges = Math.ceil((count - inputsLimit) / (MERGE_SIZE - 1))
+    if (merges > inputsLimit) {
+        return [Math.ceil(count / MERGE_SIZE), count]
+    }
+    return [merges, count - inputsLimit + merges]
+}
+
+// Plan the merges before a transfer of amount by at most inputsLimit FT UTXOs, on the UTXOs held.
+// Transfer spends the fewest largest UTXOs which pay the amount, the smallest of them are merged in groups of at most MERGE_SIZE,
+// groups are disjoint so that the merges of a round do not depend on each other.
+// When a round leaves too many UTXOs still, their outputs are merged by the next round, planned again on the UTXOs held then.
+// Returns null if the UTXOs do not pay the amount, otherwise {inputs, merges: groups of this round, mergeCount: merges of all the rounds}
+function planMerges(ftUtxos, amount, inputsLimit) {
+    const sorted = [...ftUtxos].sort((a, b) => {
+        const [x, y] = [BigInt(a.tokenAmount), BigInt(b.tokenAmount)]
+        return x > y ? -1 : x < y ? 1 : 0
+    })
+    let total = 0n, count = 0
+    while (count < sorted.length && total < amount) {
+        total += BigInt(sorted[count].tokenAmount)
+        count++
+    }
+    if (total < amount) {
+        return null
+    }
+    if (count <= inputsLimit) {
+        return {inputs: sorted.slice(0, count), merges: [], mergeCount: 0}
+    }
+    const [merges, merged] = mergeRound(count, inputsLimit)
+    const mergedUtxos = sorted.slice(count - merged, count)
+    const groups = []
+    for (let i = 0; i < merges; i++) {
+        groups.push(mergedUtxos.filter((_, j) => j % merges === i))
+    }
+    let mergeCount = 0
+    for (let left = count; left > inputsLimit;) {
+        const [roundMerges, roundMerged] = mergeRound(left, inputsLimit)
+        mergeCount += roundMerges
+        left = left - roundMerged + roundMerges
+    }
+    return {inputs: sorted.slice(0, count - merged), merges: groups, mergeCount}
+}
+
+// Merges of a round are built one after another, each spending the SPACE change of the previous one,
+// and broadcast in order while the next one is being built.
+async function runMerges(ft, {codehash, genesis, senderWif, senderAddress, purse}, groups, merged) {
+    let gas = (await ft.api.getUnspents(senderAddress)).map(utxo => ({...utxo, wif: purse}))
+    let broadcasting = Promise.resolve()
+    for (const group of groups) {
+        const r = await ft.transfer({
+            codehash, genesis, senderWif, receivers: [], isMerge: true, noBroadcast: true, changeAddress: senderAddress,
+            ftUtxos: group.map(utxo => ({...utxo, wif: senderWif})), utxos: gas,
+        })
+        broadcasting = broadcasting.then(() => ft.api.broadcast(r.routeCheckTxHex)).then(() => ft.api.broadcast(r.txHex)).then(merged)
+        const change = r.tx.outputs.length - 1
+        const output = r.tx.outputs[change]
+        if (!output.script.isPublicKeyHashOut()) {
+            // no SPACE change to spend, the next merge waits for the broadcast and spends what the wallet holds then
+            await broadcasting
+            gas = (await ft.api.getUnspents(senderAddress)).map(utxo => ({...utxo, wif: purse}))
+        } else {
+            gas = [{txId: r.txid, outputIndex: change, satoshis: output.satoshis, address: senderAddress, wif: purse}]
+        }
+    }
+    await broadcasting
+}
+
+function reportProgress(requestId, progress) {
+    Bridge.js_progress(JSON.stringify({requestId, progress}))
+}
+
+async function ftTransfer({requestId, network, purse, feeb, codehash, genesis, receivers, senderWif, senderAddress}) {
     let result
     try {
         const ft = new metaContract.FtManager({network, purse, feeb,})
-        let utxoCountTarget
-        if (receivers.length <= 5) {
-            utxoCountTarget = 20
-        } else if (receivers.length <= 12) {
-            utxoCountTarget = 8
-        } else {
-            utxoCountTarget = 3
-        }
-        while (utxoCount > utxoCountTarget) {
-            await ft.merge({codehash, genesis, ownerWif: senderWif,})
-            utxoCount -= 19
+        const amount = receivers.reduce((sum, receiver) => sum + BigInt(receiver.amount), 0n)
+        const inputsLimit = transferInputsLimit(receivers.length)
+        let done = 0
+        let plan
+        while (true) {
+            plan = planMerges(await ft.getFtUtxos(codehash, genesis, senderAddress), amount, inputsLimit)
+            if (plan === null) {
+                throw {code: -201, message: 'Insufficient token.'}
+            }
+            if (plan.merges.length === 0) {
+                break
+            }
+            const total = done + plan.mergeCount
+            reportProgress(requestId, {stage: 'merge', done, total})
+            await runMerges(ft, {codehash, genesis, senderWif, senderAddress, purse}, plan.merges, () => reportProgress(requestId, {stage: 'merge', done: ++done, total}))
         }
-        let {txid} = await ft.transfer({codehash, genesis, receivers, senderWif,})
+        reportProgress(requestId, {stage: 'transfer', done: 0, total: 0})
+        let {txid} = await ft.transfer({codehash, genesis, receivers, senderWif, ftUtxos: plan.inputs.map(utxo => ({...utxo, wif: senderWif})),})
         result = {code: 0, message: 'OK', txid,}
     } catch (e) {
         result = {code: e.code, message: e.message,}
@@ -0,0 +1,60 @@
+import multiprocessing
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import List, Iterator, Optional
+
+from mvclib.hd import Xpub, derive_xkeys_from_xkey
+
+# public data of key "./change/index" derived from an extended key
+DerivedKey = namedtuple('DerivedKey', 'path public_key address hash160')
+
+# number of keys derived by a worker process at a time, and streamed back as one chunk
+CHUNK_SIZE = 500
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def derive_keys(xpub: Xpub, index_start: int, index_end: int, change: int = 0) -> List[DerivedKey]:
+    keys: List[DerivedKey] = []
+    for i, xkey in enumerate(derive_xkeys_from_xkey(xpub, index_start, index_end, change)):
+        public_key = xkey.public_key()
+        keys.append(DerivedKey(f'{change}/{index_start + i}', public_key.hex(), xkey.address(), public_key.hash160().hex()))
+    return keys
+
+
+def _derive_chunk(xpub: str, index_start: int, index_end: int, change: int) -> List[DerivedKey]:
+    return derive_keys(Xpub(xpub), index_start, index_end, change)
+
+
+def executor() -> ProcessPoolExecutor:
+    """
+    The process pool shared by the key derivations and the transaction signing, started on first use by any thread.
+    Workers are spawned, forking a process running Qt threads and the web engine is not safe.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+
+def derive_keys_chunked(xpub: Xpub, index_start: int, index_end: int, change: int = 0, chunk_size: int = CHUNK_SIZE) -> Iterator[List[DerivedKey]]:
+    """
+    Derive keys in range [index_start, index_end) on the process pool, chunks are yielded in order as soon as they are ready.
+    Range within one chunk is derived in the calling thread, there is nothing to split.
+    Closing the iterator early cancels the chunks not started yet.
+    """
+    if index_end - index_start <= chunk_size:
+        if index_end > index_start:
+            yield derive_keys(xpub, index_start, index_end, change)
+        return
+    futures: List[Future] = [executor().submit(_derive_chunk, str(xpub), start, min(start + chunk_size, index_end), change) for start in range(index_start, index_end, chunk_size)]
+    try:
+        for future in futures:
+            yield future.result()
+    finally:
+        for future in futures:
+            future.cancel()
@@ -0,0 +1,24 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Union
+
+from mvclib.hd import Xprv, Xpub, derive_xkeys_from_xkey
+
+# BIP44 address gap limit, stop deriving after this number of consecutive unused addresses
+GAP_LIMIT = 20
+
+
+def discover_used_index(xkey: Union[Xprv, Xpub], change: int, address_used: Callable[[str], bool], gap_limit: int = GAP_LIMIT, concurrency: int = 4) -> int:
+    """
+    Derive and query addresses of "./change/index" in batches until "gap_limit" consecutive addresses are unused
+    :returns: index of the last used address, -1 if none of them is used
+    """
+    xkey = xkey.xpub() if type(xkey) is Xprv else xkey
+    last_used, index = -1, 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while index - last_used - 1 < gap_limit:
+            addresses: List[str] = [x.address() for x in derive_xkeys_from_xkey(xkey, index, index + gap_limit, change)]
+            for i, used in enumerate(executor.map(address_used, addresses)):
+                if used:
+                    last_used = index + i
+            index += gap_limit
+    return last_used
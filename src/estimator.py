@@ -0,0 +1,73 @@
+import math
+from collections import namedtuple
+from typing import Optional
+
+from mvclib.constants import TRANSACTION_FEE_RATE, P2PKH_DUST_LIMIT
+
+# byte length of a signed P2PKH input, of a compressed and of an uncompressed public key
+P2PKH_INPUT_SIZE = 148
+P2PKH_UNCOMPRESSED_INPUT_SIZE = 180
+# byte length of a P2PKH output
+P2PKH_OUTPUT_SIZE = 34
+
+# estimated byte length and fee of a transaction, amount of the change output (0 if none), and whether the inputs pay the outputs and fee
+FeeEstimate = namedtuple('FeeEstimate', 'size fee change sufficient')
+
+
+def varint_size(n: int) -> int:
+    return 1 if n < 0xfd else 3 if n <= 0xffff else 5 if n <= 0xffffffff else 9
+
+
+def output_size(locking_script_length: int) -> int:
+    return 8 + varint_size(locking_script_length) + locking_script_length
+
+
+def estimated_size(input_count: int, output_count: int) -> int:
+    """Byte length after signing of a transaction spending compressed P2PKH inputs to P2PKH outputs"""
+    return FeeEstimator(input_count, 0, input_count * P2PKH_INPUT_SIZE).size(output_count)
+
+
+def estimated_fee(input_count: int, output_count: int, fee_rate: float = TRANSACTION_FEE_RATE) -> int:
+    return math.ceil(fee_rate * estimated_size(input_count, output_count))
+
+
+class FeeEstimator:
+    """
+    Size and fee of a transaction from a tally of its inputs, in O(1) of the outputs, without building it.
+    Inputs are tallied by count, total amount and byte length, outputs are P2PKH unless their byte length is given.
+    Estimates are the same as Transaction.estimated_fee and Transaction.add_change.
+    """
+
+    def __init__(self, input_count: int = 0, input_total: int = 0, inputs_size: int = 0, fee_rate: float = TRANSACTION_FEE_RATE):
+        self.input_count = input_count
+        self.input_total = input_total
+        self.inputs_size = inputs_size
+        self.fee_rate = fee_rate
+
+    def add_inputs(self, count: int, total: int, input_size: int = P2PKH_INPUT_SIZE) -> 'FeeEstimator':
+        self.input_count += count
+        self.input_total += total
+        self.inputs_size += count * input_size
+        return self
+
+    def size(self, output_count: int, outputs_size: Optional[int] = None) -> int:
+        outputs_size = output_count * P2PKH_OUTPUT_SIZE if outputs_size is None else outputs_size
+        return 4 + varint_size(self.input_count) + self.inputs_size + varint_size(output_count) + outputs_size + 4
+
+    def fee(self, output_count: int, outputs_size: Optional[int] = None) -> int:
+        return math.ceil(self.fee_rate * self.size(output_count, outputs_size))
+
+    def estimate(self, amount: int, output_count: int, outputs_size: Optional[int] = None) -> FeeEstimate:
+        """Paying amount in total to the outputs, and the rest to a P2PKH change output if it is not dust"""
+        outputs_size = output_count * P2PKH_OUTPUT_SIZE if outputs_size is None else outputs_size
+        change = self.input_total - amount - self.fee(output_count + 1, outputs_size + P2PKH_OUTPUT_SIZE)
+        if change >= P2PKH_DUST_LIMIT:
+            return FeeEstimate(self.size(output_count + 1, outputs_size + P2PKH_OUTPUT_SIZE), self.input_total - amount - change, change, True)
+        # without change, whatever is left is paid as fee
+        fee = self.fee(output_count, outputs_size)
+        sufficient = self.input_total - amount >= fee
+        return FeeEstimate(self.size(output_count, outputs_size), self.input_total - amount if sufficient else fee, 0, sufficient)
+
+    def max_amount(self, output_count: int = 1) -> int:
+        """Amount in total to the outputs which spends all the inputs, without change"""
+        return max(self.input_total - self.fee(output_count), 0)
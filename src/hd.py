@@ -1,6 +1,7 @@
 import re
 from contextlib import suppress
 from enum import Enum
+from typing import Callable
 
 from PyQt6 import QtCore, QtGui
 from PyQt6.QtWidgets import QDialog
@@ -18,8 +19,29 @@ class Mode(int, Enum):
     Xpub = 3
 
 
+class DeriveJob(QtCore.QRunnable):
+
+    def __init__(self, generation: int, derive: Callable[[], str], derived: QtCore.pyqtBoundSignal):
+        super(DeriveJob, self).__init__()
+        self.generation = generation
+        self.derive = derive
+        self.derived = derived
+
+    def run(self):
+        text = ''
+        with suppress(Exception):
+            text = self.derive()
+        # dialog might have been closed already
+        with suppress(RuntimeError):
+            self.derived.emit(self.generation, text)
+
+
 class HdUi(QDialog, Ui_dialogHd):
     mnemonic_set = QtCore.pyqtSignal(object)
+    xprv_derived = QtCore.pyqtSignal(int, str)
+
+    # milliseconds to wait for the typing to pause before deriving
+    derive_delay = 300
 
     def __init__(self, mnemonic: str = '', path: str = '', passphrase: str = '', xprv: str = '', xpub: str = '', chain: Chain = Chain.MAIN, mode: Mode = Mode.Readonly):
         super(HdUi, self).__init__()
@@ -41,9 +63,20 @@ class HdUi(QDialog, Ui_dialogHd):
         self.plainTextEditXprv.setPlainText(xprv)
         self.plainTextEditXpub.setPlainText(xpub)
 
-        self.plainTextEditMnemonic.textChanged.connect(self.derive_from_mnemonic)
-        self.lineEditPath.textChanged.connect(self.derive_from_mnemonic)
-        self.lineEditPassphrase.textChanged.connect(self.derive_from_mnemonic)
+        # PBKDF2 of the mnemonic runs on a worker when the input pauses, results of the stale input are dropped
+        self.derive_generation = 0
+        self.derive_pool = QtCore.QThreadPool(self)
+        self.derive_pool.setMaxThreadCount(1)
+        self.derive_timer = QtCore.QTimer(self)
+        self.derive_timer.setSingleShot(True)
+        self.derive_timer.setInterval(HdUi.derive_delay)
+        # noinspection PyUnresolvedReferences
+        self.derive_timer.timeout.connect(self.derive_from_mnemonic)
+        self.xprv_derived.connect(self.mnemonic_derived)
+
+        self.plainTextEditMnemonic.textChanged.connect(self.mnemonic_changed)
+        self.lineEditPath.textChanged.connect(self.mnemonic_changed)
+        self.lineEditPassphrase.textChanged.connect(self.mnemonic_changed)
         self.plainTextEditXprv.textChanged.connect(self.derive_from_xprv)
         self.plainTextEditXpub.textChanged.connect(lambda: self.pushButtonOk.setEnabled(self.xpub_valid()))
         self.pushButtonOk.clicked.connect(self.ok_button_clicked)
@@ -67,12 +100,6 @@ class HdUi(QDialog, Ui_dialogHd):
             if xprv:
                 self.derive_from_xprv()
 
-    def mnemonic_valid(self) -> bool:
-        with suppress(Exception):
-            validate_mnemonic(mnemonic=self.plainTextEditMnemonic.toPlainText().strip())
-            return True
-        return False
-
     def path_valid(self) -> bool:
         match_groups = re.match(r"^m(/\d+'?)+$", self.lineEditPath.text().strip())
         return True if match_groups else False
@@ -98,14 +125,34 @@ class HdUi(QDialog, Ui_dialogHd):
         else:
             super().keyPressEvent(a0)
 
+    def mnemonic_changed(self):
+        self.derive_generation += 1
+        self.pushButtonOk.setEnabled(False)
+        self.derive_timer.start()
+
     def derive_from_mnemonic(self):
-        text = ''
-        if self.mnemonic_valid() and self.path_valid():
-            mnemonic = self.plainTextEditMnemonic.toPlainText().strip()
-            path = self.lineEditPath.text().strip()
-            passphrase = self.lineEditPassphrase.text()
-            text = str(derive_xprv_from_mnemonic(mnemonic=mnemonic, passphrase=passphrase, path=path, chain=self.chain))
-        self.plainTextEditXprv.setPlainText(text)
+        self.derive_timer.stop()
+        self.derive_generation += 1
+        self.pushButtonOk.setEnabled(False)
+        mnemonic = self.plainTextEditMnemonic.toPlainText().strip()
+        path = self.lineEditPath.text().strip()
+        passphrase = self.lineEditPassphrase.text()
+        chain = self.chain
+        path_valid = self.path_valid()
+
+        def derive() -> str:
+            validate_mnemonic(mnemonic=mnemonic)
+            if not path_valid:
+                return ''
+            return str(derive_xprv_from_mnemonic(mnemonic=mnemonic, passphrase=passphrase, path=path, chain=chain))
+
+        self.derive_pool.clear()
+        self.derive_pool.start(DeriveJob(self.derive_generation, derive, self.xprv_derived))
+
+    def mnemonic_derived(self, generation: int, text: str):
+        if generation == self.derive_generation:
+            self.plainTextEditXprv.setPlainText(text)
+            self.pushButtonOk.setEnabled(self.xpub_valid())
 
     def derive_from_xprv(self):
         self.plainTextEditXpub.setPlainText(str(Xprv(self.plainTextEditXprv.toPlainText().strip()).xpub()) if self.xprv_valid() else '')
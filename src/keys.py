@@ -1,99 +1,198 @@
 import random
-from typing import List, Optional, Any, Union, Dict
+from typing import List, Optional, Union, Dict, Set, Tuple, Callable
 
 from PyQt6 import QtCore
 from PyQt6.QtWidgets import QWidget, QTableView, QPushButton
-from mvclib import Unspent
-from mvclib.hd import Xprv, Xpub, derive_xkeys_from_xkey
+from mvclib.hd import Xprv, Xpub
+from mvclib.keys import PrivateKey
 
-from base import font, set_table_view, copy_table_selected, table_select_all, require_password
+from base import LazyTableModel, set_table_view, copy_table_selected, table_select_all, require_password
+from cache import KeyCache, wallet_key
+from derivation import DerivedKey, derive_keys_chunked
 from designer.keys import Ui_widgetKeys
 from key import KeyUi
+from payout import PayoutPlans
 from send_unspents import SendUnspentsUi
-from utils import format_coin
+from store import UnspentStore
+from utils import format_coins
 
 
-class XkeyModel(QtCore.QAbstractTableModel):
-    def __init__(self, xkeys: Optional[List[Union[Xpub, Xprv]]] = None, unspents: Optional[List[Unspent]] = None, change: int = 0):
-        super(XkeyModel, self).__init__()
-        self.xkeys: List[Union[Xpub, Xprv]] = xkeys or []
-        self._xkeys: List[str] = []
-        self.unspents: List[Unspent] = []
+class DeriveThread(QtCore.QThread):
+    """Derive the keys in ranges on the process pool, and stream them back chunk by chunk"""
+    derived = QtCore.pyqtSignal(int, int, object)
+
+    def __init__(self, xpub: Xpub, ranges: List[Tuple[int, int, int]], parent: Optional[QtCore.QObject] = None):
+        super(DeriveThread, self).__init__(parent)
+        self.xpub = xpub
+        # (change, index start, index end)
+        self.ranges = ranges
+
+    def run(self):
+        for change, index_start, index_end in self.ranges:
+            chunks = derive_keys_chunked(self.xpub, index_start, index_end, change)
+            try:
+                for keys in chunks:
+                    if self.isInterruptionRequested():
+                        return
+                    self.derived.emit(change, index_start, keys)
+                    index_start += len(keys)
+            finally:
+                chunks.close()
+
+
+class XkeyModel(LazyTableModel):
+    """
+    Virtual model of keys "./change/0" to "./change/limit-1".
+    Rows are derived and formatted block by block when they are painted, only the recently painted blocks are kept.
+    Addresses derived in background are indexed, so that searching does not need to format every row.
+    """
+    block_size = 100
+    row_cache_capacity = block_size * 20
+
+    def __init__(self, xpub: Xpub, key_cache: KeyCache, change: int, limit: int, unspents: Optional[UnspentStore] = None):
+        super(XkeyModel, self).__init__(['Path', 'Public Key', 'Address', 'UTXO', 'Balance'])
+        self.xpub = xpub
+        self.key_cache = key_cache
         self.change: int = change
+        self.limit: int = limit
+        # address -> key index, of the first "indexed" keys
+        self.address_index: Dict[str, int] = {}
+        self.indexed: int = 0
+        self.search_text: str = ''
+        # key indexes of the rows matching the search, None when not searching
+        self.matched: Optional[List[int]] = None
+        self.unspents: UnspentStore = UnspentStore.empty()
+        # address -> (number of unspents, balance)
+        self.address_summary: Dict[str, Tuple[int, int]] = {}
+        self.index_keys(self.key_cache.cached(self.xpub, self.change, self.limit), 0)
         self.update_fields(unspents)
-        self.headers = ['Path', 'Public Key', 'Address', 'UTXO', 'Balance']
-
-    def update_fields(self, unspents: Optional[List[Unspent]] = None):
-        self.unspents = unspents or []
-        self._xkeys = []
-        for i in range(len(self.xkeys)):
-            path = f'{self.change}/{str(i).zfill(len(str(len(self.xkeys))))}'
-            balance = sum([unspent.satoshi if unspent.address == self.xkeys[i].address() else 0 for unspent in self.unspents])
-            utxo = sum([1 if unspent.address == self.xkeys[i].address() else 0 for unspent in self.unspents])
-            self._xkeys.append((path, self.xkeys[i].public_key().hex(), self.xkeys[i].address(), str(utxo), format_coin(balance)))
-        # noinspection PyUnresolvedReferences
-        self.layoutChanged.emit()
-
-    def data(self, index: QtCore.QModelIndex, role: int = ...) -> Any:
-        if role == QtCore.Qt.ItemDataRole.DisplayRole:
-            return self._xkeys[index.row()][index.column()]
-        elif role == QtCore.Qt.ItemDataRole.FontRole:
-            return font('Monaco', 13)
 
-    def rowCount(self, parent: QtCore.QModelIndex = ...) -> int:
-        return len(self._xkeys)
+    def update_limit(self, limit: int):
+        self.beginResetModel()
+        self.limit = limit
+        self.row_cache.clear()
+        self.address_index, self.indexed = {}, 0
+        self.index_keys(self.key_cache.cached(self.xpub, self.change, self.limit), 0)
+        self.matched = self.search_rows(self.search_text)
+        self.endResetModel()
+
+    def index_keys(self, keys: List[DerivedKey], index_start: int):
+        """Index the addresses of keys derived in order, matching rows are appended when searching"""
+        if index_start != self.indexed:
+            return
+        keys = keys[:self.limit - index_start]
+        for i, key in enumerate(keys):
+            self.address_index[key.address] = index_start + i
+        self.indexed += len(keys)
+        if self.matched is not None:
+            matched = [index_start + i for i, key in enumerate(keys) if self.search_text in key.address]
+            if matched:
+                self.beginInsertRows(QtCore.QModelIndex(), len(self.matched), len(self.matched) + len(matched) - 1)
+                self.matched.extend(matched)
+                self.endInsertRows()
+
+    def search(self, text: str):
+        self.beginResetModel()
+        self.search_text = text
+        self.matched = self.search_rows(text)
+        self.endResetModel()
+
+    def search_rows(self, text: str) -> Optional[List[int]]:
+        """Key indexes of the addresses containing text, in order"""
+        if not text:
+            return None
+        return [index for address, index in self.address_index.items() if text in address]
 
-    def columnCount(self, parent: QtCore.QModelIndex = ...) -> int:
-        return len(self.headers)
+    def key_index(self, row: int) -> int:
+        return self.matched[row] if self.matched is not None else row
 
-    def headerData(self, section: int, orientation: QtCore.Qt.Orientation, role: int = ...) -> Any:
-        if role == QtCore.Qt.ItemDataRole.DisplayRole and orientation == QtCore.Qt.Orientation.Horizontal:
-            return self.headers[section]
-        return super().headerData(section, orientation, role)
+    def row_key(self, row: int) -> int:
+        return self.key_index(row)
+
+    def format_rows(self, row: int) -> Dict[int, Tuple[str, ...]]:
+        """Keys are derived in the block of the key index of row"""
+        index = self.key_index(row)
+        index_start = index - index % XkeyModel.block_size
+        keys = self.key_cache.keys(self.xpub, self.change, index_start, min(index_start + XkeyModel.block_size, self.limit))
+        summaries = [self.address_summary.get(key.address, (0, 0)) for key in keys]
+        balances = format_coins([balance for _, balance in summaries])
+        width = len(str(self.limit))
+        return {
+            index_start + i: (f'{self.change}/{str(index_start + i).zfill(width)}', key.public_key, key.address, str(summaries[i][0]), balances[i])
+            for i, key in enumerate(keys)
+        }
+
+    def unspent_addresses(self, rows: Set[int]) -> Dict[str, int]:
+        """
+        Addresses holding unspents among rows, and their key indexes.
+        Looked up in the address index rather than formatting the rows, keys not indexed yet are left out until they are derived.
+        """
+        indexes = set(self.key_index(row) for row in rows)
+        return {address: self.address_index[address] for address in self.address_summary if self.address_index.get(address, -1) in indexes}
+
+    def update_fields(self, unspents: Optional[UnspentStore] = None):
+        self.unspents = unspents if unspents is not None else UnspentStore.empty()
+        self.address_summary = self.unspents.address_summary()
+        self.row_cache.clear()
+        if self.rowCount() > 0:
+            # noinspection PyUnresolvedReferences
+            self.dataChanged.emit(self.index(0, 3), self.index(self.rowCount() - 1, 4))
+
+    def unspents_count(self, rows: Set[int]) -> int:
+        return sum([self.address_summary[address][0] for address in self.unspent_addresses(rows)])
+
+    def unspents_of(self, rows: Set[int], xkey: Union[Xprv, Xpub]) -> Tuple[UnspentStore, Callable[[str, int, int], List[PrivateKey]]]:
+        """Unspents of rows, and their private keys derived by the key index of rows"""
+        indexes = self.unspent_addresses(rows)
+
+        def private_keys(address: str, _change: int, _index: int) -> List[PrivateKey]:
+            return [xkey.ckd(self.change).ckd(indexes[address]).private_key()] if type(xkey) is Xprv else []
+
+        return self.unspents.select(self.unspents.rows_of(list(indexes.keys()))), private_keys
+
+    def rowCount(self, parent: QtCore.QModelIndex = ...) -> int:
+        return len(self.matched) if self.matched is not None else self.limit
 
 
 class KeysUi(QWidget, Ui_widgetKeys):
     request_refresh = QtCore.pyqtSignal()
 
-    def __init__(self, password: str, w: Dict, unspents: Optional[List[Unspent]] = None):
+    def __init__(self, password: str, w: Dict, key_cache: KeyCache, payout_plans: Optional[PayoutPlans] = None, unspents: Optional[UnspentStore] = None):
         super(KeysUi, self).__init__()
         self.setupUi(self)
 
         self.password = password
+        self.w = w
+        self.key_cache = key_cache
+        self.payout_plans = payout_plans
         xprv = w.get('xprv')
         if xprv:
             self.xkey: Union[Xpub, Xprv] = Xprv(xprv)
+            self.xpub: Xpub = Xpub(w['xpub']) if w.get('xpub') else self.xkey.xpub()
         else:
             self.xkey: Union[Xpub, Xprv] = Xpub(w['xpub'])
+            self.xpub: Xpub = self.xkey
         self.chain = self.xkey.chain
 
-        self.receive_xkeys: List[Union[Xpub, Xprv]] = derive_xkeys_from_xkey(self.xkey, 0, w['receive_limit'], 0)
-        self.change_xkeys: List[Union[Xpub, Xprv]] = derive_xkeys_from_xkey(self.xkey, 0, w['change_limit'], 1)
-        self.unspents: List[Unspent] = unspents or []
-
-        self.receive_model = XkeyModel(self.receive_xkeys, self.unspents, 0)
-        self.receive_proxy_model = QtCore.QSortFilterProxyModel()
-        self.receive_proxy_model.setSourceModel(self.receive_model)
-        self.receive_proxy_model.setFilterKeyColumn(2)
-        self.tableViewReceive.setModel(self.receive_proxy_model)
-        set_table_view(self.tableViewReceive)
-        self.tableViewReceive.sortByColumn(0, QtCore.Qt.SortOrder.AscendingOrder)
-
-        self.change_model = XkeyModel(self.change_xkeys, self.unspents, 1)
-        self.change_proxy_model = QtCore.QSortFilterProxyModel()
-        self.change_proxy_model.setSourceModel(self.change_model)
-        self.change_proxy_model.setFilterKeyColumn(2)
-        self.tableViewChange.setModel(self.change_proxy_model)
-        set_table_view(self.tableViewChange)
-        self.tableViewChange.sortByColumn(0, QtCore.Qt.SortOrder.AscendingOrder)
-
-        self.lineEditReceiveSearch.textChanged.connect(self.receive_proxy_model.setFilterFixedString)
-        self.lineEditChangeSearch.textChanged.connect(self.change_proxy_model.setFilterFixedString)
+        self.unspents: UnspentStore = unspents if unspents is not None else UnspentStore.empty()
+        # unspents from the cache might be spent already, they are not sent until the network refresh succeeds
+        self.unspents_refreshed = False
+
+        self.receive_model = XkeyModel(self.xpub, self.key_cache, 0, w['receive_limit'], self.unspents)
+        self.tableViewReceive.setModel(self.receive_model)
+        KeysUi.set_table_view(self.tableViewReceive)
+
+        self.change_model = XkeyModel(self.xpub, self.key_cache, 1, w['change_limit'], self.unspents)
+        self.tableViewChange.setModel(self.change_model)
+        KeysUi.set_table_view(self.tableViewChange)
+
+        self.lineEditReceiveSearch.textChanged.connect(self.receive_model.search)
+        self.lineEditChangeSearch.textChanged.connect(self.change_model.search)
 
         self.setWindowTitle(f'Keys / {w["name"]}')
         self.tabWidgetKeys.setCurrentIndex(0)
 
-        self.tableViewReceive.selectionModel().selectionChanged.connect(lambda: self.pushButtonReceiveSend.setEnabled(len(self.unspents_selected(self.tableViewReceive)) > 0))
+        self.tableViewReceive.selectionModel().selectionChanged.connect(lambda: self.enable_send_button(self.pushButtonReceiveSend, self.tableViewReceive))
         self.tableViewReceive.selectionModel().selectionChanged.connect(lambda: KeysUi.enable_key_button(self.pushButtonReceiveKey, self.tableViewReceive))
         self.pushButtonReceiveSend.setEnabled(False)
         self.pushButtonReceiveSend.clicked.connect(lambda: self.send_button_clicked(self.tableViewReceive))
@@ -101,9 +200,9 @@ class KeysUi(QWidget, Ui_widgetKeys):
         self.pushButtonReceiveCopy.clicked.connect(lambda: copy_table_selected(self.tableViewReceive))
         self.pushButtonReceiveSelectAll.clicked.connect(lambda: table_select_all(self.tableViewReceive))
         self.pushButtonReceiveKey.setEnabled(False)
-        self.pushButtonReceiveKey.clicked.connect(lambda: require_password(self, KeysUi.key_button_clicked, self.password, t=self.tableViewReceive, xkeys=self.receive_xkeys))
+        self.pushButtonReceiveKey.clicked.connect(lambda: require_password(self, self.key_button_clicked, self.password, t=self.tableViewReceive, change=0))
 
-        self.tableViewChange.selectionModel().selectionChanged.connect(lambda: self.pushButtonChangeSend.setEnabled(len(self.unspents_selected(self.tableViewChange)) > 0))
+        self.tableViewChange.selectionModel().selectionChanged.connect(lambda: self.enable_send_button(self.pushButtonChangeSend, self.tableViewChange))
         self.tableViewChange.selectionModel().selectionChanged.connect(lambda: KeysUi.enable_key_button(self.pushButtonChangeKey, self.tableViewChange))
         self.pushButtonChangeSend.setEnabled(False)
         self.pushButtonChangeSend.clicked.connect(lambda: self.send_button_clicked(self.tableViewChange))
@@ -111,7 +210,7 @@ class KeysUi(QWidget, Ui_widgetKeys):
         self.pushButtonChangeCopy.clicked.connect(lambda: copy_table_selected(self.tableViewChange))
         self.pushButtonChangeSelectAll.clicked.connect(lambda: table_select_all(self.tableViewChange))
         self.pushButtonChangeKey.setEnabled(False)
-        self.pushButtonChangeKey.clicked.connect(lambda: require_password(self, KeysUi.key_button_clicked, self.password, t=self.tableViewChange, xkeys=self.change_xkeys))
+        self.pushButtonChangeKey.clicked.connect(lambda: require_password(self, self.key_button_clicked, self.password, t=self.tableViewChange, change=1))
 
         if type(self.xkey) is Xpub:
             self.pushButtonReceiveSend.setVisible(False)
@@ -119,50 +218,88 @@ class KeysUi(QWidget, Ui_widgetKeys):
             self.pushButtonChangeSend.setVisible(False)
             self.pushButtonChangeKey.setVisible(False)
 
-    def update_fields(self, password: Optional[str] = None, w: Optional[Dict] = None, unspents: Optional[List[Unspent]] = None):
+        self.derive_thread: Optional[DeriveThread] = None
+        self.derive_uncached()
+
+    def update_fields(self, password: Optional[str] = None, w: Optional[Dict] = None, unspents: Optional[UnspentStore] = None, unspents_refreshed: Optional[bool] = None):
         if password is not None:
             self.password = password
         if w is not None:
+            self.w = w
             self.setWindowTitle(f'Keys / {w["name"]}')
+            if self.receive_model.limit != w['receive_limit'] or self.change_model.limit != w['change_limit']:
+                self.stop_derivation()
+                self.receive_model.update_limit(w['receive_limit'])
+                self.change_model.update_limit(w['change_limit'])
+                self.derive_uncached()
+                unspents = self.unspents
+        if unspents_refreshed is not None:
+            self.unspents_refreshed = unspents_refreshed
         if unspents is not None:
             self.unspents = unspents
-            self.receive_proxy_model.beginResetModel()
             self.receive_model.update_fields(self.unspents)
-            self.receive_proxy_model.endResetModel()
             self.tableViewReceive.clearSelection()
-            self.change_proxy_model.beginResetModel()
             self.change_model.update_fields(self.unspents)
-            self.change_proxy_model.endResetModel()
             self.tableViewChange.clearSelection()
 
-    def unspents_selected(self, t: QTableView) -> List[Unspent]:
+    @classmethod
+    def set_table_view(cls, t: QTableView):
+        # rows are derived when painted, measure the first block only and do not sort them
+        t.horizontalHeader().setResizeContentsPrecision(XkeyModel.block_size)
+        set_table_view(t)
+        t.setSortingEnabled(False)
+
+    @classmethod
+    def unspents_selected_count(cls, t: QTableView) -> int:
+        rows = set(index.row() for index in t.selectionModel().selection().indexes())
+        return t.model().unspents_count(rows)
+
+    def unspents_selected(self, t: QTableView) -> Tuple[UnspentStore, Callable[[str, int, int], List[PrivateKey]]]:
         rows = set(index.row() for index in t.selectionModel().selection().indexes())
-        addresses = [t.model().index(row, 2).data() for row in rows]
-        unspents: List[Unspent] = []
-        for unspent in self.unspents:
-            if unspent.address in addresses:
-                unspents.append(unspent)
-        return unspents
+        return t.model().unspents_of(rows, self.xkey)
 
     def send_button_clicked(self, t: QTableView):
-        selected_unspents = self.unspents_selected(t)
-        change_address = random.choice(self.change_xkeys).address()
-        dialog = SendUnspentsUi(self.password, selected_unspents, self.chain, change_address, True)
+        selected_unspents, private_keys = self.unspents_selected(t)
+        change_index = random.randrange(self.w.get('change_used', -1) + 1, self.change_model.limit)
+        change_address = self.key_cache.key(self.xpub, 1, change_index).address
+        dialog = SendUnspentsUi(self.password, selected_unspents, self.chain, change_address, True, private_keys, self.payout_plans, wallet_key(str(self.xpub)))
         if dialog.exec():
             t.clearSelection()
             self.request_refresh.emit()
 
+    def enable_send_button(self, b: QPushButton, t: QTableView):
+        b.setEnabled(self.unspents_refreshed and KeysUi.unspents_selected_count(t) > 0)
+
     @classmethod
     def enable_key_button(cls, b: QPushButton, t: QTableView):
         rows = set(index.row() for index in t.selectionModel().selection().indexes())
         b.setEnabled(len(rows) == 1)
 
-    @classmethod
-    def key_button_clicked(cls, t: QTableView, xkeys: List[Union[Xpub, Xprv]]):
-        row = t.selectionModel().selection().indexes()[0].row()
-        address = t.model().index(row, 2).data()
-        for xkey in xkeys:
-            if xkey.address() == address:
-                dialog = KeyUi(wif=xkey.private_key().wif())
-                dialog.exec()
-                break
+    def key_button_clicked(self, t: QTableView, change: int):
+        index = t.model().key_index(t.selectionModel().selection().indexes()[0].row())
+        dialog = KeyUi(wif=self.xkey.ckd(change).ckd(index).private_key().wif())
+        dialog.exec()
+
+    def derive_uncached(self):
+        """Keys not in the cache are derived in background, rows are appended as soon as each chunk is derived"""
+        ranges = [(model.change, model.indexed, model.limit) for model in (self.receive_model, self.change_model) if model.indexed < model.limit]
+        if ranges:
+            self.derive_thread = DeriveThread(self.xpub, ranges, self)
+            self.derive_thread.derived.connect(self.keys_derived)
+            self.derive_thread.finished.connect(self.derive_finished)
+            self.derive_thread.start()
+
+    def keys_derived(self, change: int, index_start: int, keys: List[DerivedKey]):
+        self.key_cache.extend(self.xpub, change, index_start, keys)
+        model = self.receive_model if change == 0 else self.change_model
+        model.index_keys(keys, index_start)
+
+    def derive_finished(self):
+        self.key_cache.save()
+
+    def stop_derivation(self):
+        if self.derive_thread:
+            self.derive_thread.derived.disconnect()
+            self.derive_thread.requestInterruption()
+            self.derive_thread.wait()
+            self.derive_thread = None
@@ -1,7 +1,7 @@
 from typing import Optional
 
 from PyQt6 import QtGui, QtCore
-from PyQt6.QtWidgets import QDialog, QLabel, QGridLayout
+from PyQt6.QtWidgets import QDialog, QLabel, QGridLayout, QProgressBar, QPushButton
 
 
 class LoadingUi(QDialog):
@@ -9,10 +9,10 @@ class LoadingUi(QDialog):
     def __init__(self, text: Optional[str] = None):
         super(LoadingUi, self).__init__()
         self.setFixedSize(400, 100)
-        label = QLabel(text or '')
-        label.setAlignment(QtCore.Qt.AlignmentFlag.AlignCenter)
+        self.label = QLabel(text or '')
+        self.label.setAlignment(QtCore.Qt.AlignmentFlag.AlignCenter)
         self.setLayout(QGridLayout())
-        self.layout().addWidget(label)
+        self.layout().addWidget(self.label)
         self.setWindowFlag(QtCore.Qt.WindowType.FramelessWindowHint)
 
     def keyPressEvent(self, a0: QtGui.QKeyEvent) -> None:
@@ -20,3 +20,27 @@ class LoadingUi(QDialog):
             return
         else:
             super().keyPressEvent(a0)
+
+
+class ProgressUi(LoadingUi):
+    """Loading dialog with a progress bar, busy when the total is unknown, and an optional cancel button"""
+    cancel_clicked = QtCore.pyqtSignal()
+
+    def __init__(self, text: Optional[str] = None):
+        super(ProgressUi, self).__init__(text)
+        self.setFixedSize(400, 140)
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 0)
+        self.layout().addWidget(self.progress_bar)
+        self.cancel_button = QPushButton('Cancel')
+        # noinspection PyUnresolvedReferences
+        self.cancel_button.clicked.connect(self.cancel_clicked)
+        self.layout().addWidget(self.cancel_button)
+
+    def update_progress(self, text: str, done: int, total: int):
+        self.label.setText(text)
+        self.progress_bar.setRange(0, total)
+        self.progress_bar.setValue(done)
+
+    def set_cancellable(self, cancellable: bool):
+        self.cancel_button.setEnabled(cancellable)
@@ -1,20 +1,110 @@
-from typing import Dict, List
+import json
+import threading
+from typing import Dict, List, Tuple, Union
 
 import requests
+from mvclib.constants import Chain
 from mvclib.service import MvcApi
+from mvclib.service.provider import BroadcastResult
 from mvclib.utils import decode_address
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
 
 TIMEOUT = 3
+# number of hosts to keep connection pools for, and number of keep-alive connections per host
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+
+_session = None
+_providers: Dict[Tuple[Chain, str], 'MetasvApi'] = {}
+# session and providers are created on first use by whichever thread comes first
+_lock = threading.Lock()
+
+
+def _create_session():
+    if httpx:
+        # HTTP/2 is only available when package "h2" is installed as well
+        try:
+            limits = httpx.Limits(max_connections=POOL_CONNECTIONS * POOL_MAXSIZE, max_keepalive_connections=POOL_CONNECTIONS * POOL_MAXSIZE)
+            return httpx.Client(http2=True, limits=limits)
+        except ImportError:
+            pass
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
+    return s
+
+
+def session():
+    """The connection-pooled HTTP session shared by all the chain API traffic"""
+    global _session
+    with _lock:
+        if _session is None:
+            _session = _create_session()
+        return _session
+
+
+def _post(url: str, data: str, headers: Dict, timeout: int):
+    if httpx and isinstance(session(), httpx.Client):
+        return session().post(url, content=data, headers=headers, timeout=timeout)
+    return session().post(url, data=data, headers=headers, timeout=timeout)
+
+
+class MetasvApi(MvcApi):
+    """MvcApi sending requests through the shared session, so that warm connections are reused"""
+
+    def get(self, **kwargs) -> Union[Dict, List[Dict]]:
+        r = session().get(kwargs['url'], headers=kwargs.get('headers') or self.headers, params=kwargs.get('params'), timeout=kwargs.get('timeout') or self.timeout)
+        r.raise_for_status()
+        return r.json()
+
+    def broadcast(self, raw: str) -> BroadcastResult:
+        propagated, message = False, ''
+        try:
+            _r = _post(f'{self.url}/tx/broadcast', json.dumps({'hex': raw}), self.headers, self.timeout)
+            _r.raise_for_status()
+            r = _r.json()
+            assert r, f'empty response {r}'
+            if r.get('txid'):
+                propagated, message = True, r['txid']
+            else:
+                propagated, message = False, r.get('message')
+        except Exception as e:
+            message = message or str(e)
+        return BroadcastResult(propagated, message)
+
+    def transaction_known(self, txid: str) -> bool:
+        """Transaction is known when it is in the mempool or in a block, the API answers 404 otherwise"""
+        r = session().get(f'{self.url}/tx/{txid}', headers=self.headers, timeout=self.timeout)
+        if r.status_code == 404:
+            return False
+        r.raise_for_status()
+        return True
+
+    def address_used(self, address: str) -> bool:
+        """Address is used when there is any transaction in its history"""
+        return len(self.get(url=f'{self.url}/address/{address}/tx')) > 0
+
+
+def get_provider(chain: Chain, client_key: str = '') -> MetasvApi:
+    key = (chain, client_key)
+    with _lock:
+        if key not in _providers:
+            _providers[key] = MetasvApi(chain=chain, timeout=TIMEOUT, client_key=client_key)
+        return _providers[key]
 
 
 def ft_balance(address: str, client_key: str = '', **kwargs) -> List[Dict]:
     try:
         _, chain = decode_address(address)
-        p = MvcApi(chain=chain, client_key=client_key)
+        p = get_provider(chain, client_key)
         path = f'/contract/ft/address/{address}/balance'
-        _r = requests.get(f'{p.url}{path}', headers=p.parse_headers(path), timeout=TIMEOUT)
-        _r.raise_for_status()
-        return _r.json()
+        return p.get(url=f'{p.url}{path}', headers=p.parse_headers(path))
     except Exception as e:
         if kwargs.get('throw'):
             raise e
@@ -0,0 +1,219 @@
+import os
+import threading
+from contextlib import suppress
+from typing import Callable, Dict, List, Optional, Tuple
+
+from mvclib import Transaction, Unspent
+from mvclib.constants import Chain, TRANSACTION_FEE_RATE
+from mvclib.keys import PrivateKey
+from mvclib.service.provider import BroadcastResult
+from mvclib.transaction import TxOutput
+from mvclib.wallet import create_transaction
+
+from estimator import FeeEstimator
+from metasv import get_provider
+from sender import SendThread, SendStage, sign_transactions
+from utils import encrypt_json, decrypt_json, format_coin
+
+# receivers paid by one transaction at most, more of them are paid by a plan of batch transactions
+BATCH_OUTPUTS = 1000
+
+
+def batch_amounts(receivers: List[Tuple[str, int]], fee_rate: float = TRANSACTION_FEE_RATE, batch_outputs: int = BATCH_OUTPUTS) -> List[int]:
+    """Amount to fund every batch with, its receivers in total and the fee of spending it to them without change"""
+    amounts = []
+    for i in range(0, len(receivers), batch_outputs):
+        batch = receivers[i:i + batch_outputs]
+        amounts.append(sum([satoshi for _, satoshi in batch]) + FeeEstimator(fee_rate=fee_rate).add_inputs(1, 0).fee(len(batch)))
+    return amounts
+
+
+class PayoutPlans:
+    """
+    Signed transactions of the payouts not broadcast completely, one plan for every wallet in the account, encrypted by the account password.
+    Plan is {'receivers': int, 'total': int, 'fee': int, 'transactions': [raw], 'txids': [txid], 'broadcast': number of transactions broadcast}
+    Plans are put by the payout threads and removed or re-encrypted by the GUI thread, they are copied in and out under a lock.
+    """
+
+    def __init__(self, file: str, password: str):
+        self.file = file
+        self.password = password
+        self.lock = threading.RLock()
+        # wallet key -> plan
+        self.plans: Dict[str, Dict] = {}
+        with suppress(Exception):
+            with open(self.file, 'rb') as f:
+                self.plans = decrypt_json(f.read(), self.password)
+
+    def plan(self, wallet: str) -> Optional[Dict]:
+        with self.lock:
+            plan = self.plans.get(wallet)
+            return dict(plan) if plan is not None else None
+
+    def put(self, wallet: str, plan: Dict):
+        with self.lock:
+            self.plans[wallet] = dict(plan)
+            self.save()
+
+    def remove(self, wallet: str):
+        with self.lock:
+            if self.plans.pop(wallet, None) is not None:
+                self.save()
+
+    def update_fields(self, password: str):
+        """Plans stay encrypted by the old password if they cannot be saved"""
+        with self.lock:
+            old_password, self.password = self.password, password
+            try:
+                self.save()
+            except OSError:
+                self.password = old_password
+                raise
+
+    def save(self):
+        """Replace the file by a complete one, so that a crash never leaves a partial plan. Errors are raised, a plan not saved cannot be resumed"""
+        with self.lock:
+            temp = f'{self.file}.tmp'
+            with open(temp, 'wb') as f:
+                f.write(encrypt_json(self.plans, self.password))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, self.file)
+
+
+class PayoutThread(SendThread):
+    """
+    Pay receivers beyond one transaction by a plan of transactions, built, signed and broadcast off the GUI thread.
+    A split transaction funds every batch by an output of its exact amount, so that the batches do not depend on each other and are signed on the process pool together.
+    The plan is persisted once signed and after every transaction broadcast, nothing is broadcast if it cannot be persisted.
+    Transactions are broadcast in order and the plan is kept until all of them are broadcast, so an interrupted payout resumes from it.
+    Cancelling during the broadcast stops after the transaction being broadcast.
+    """
+
+    def __init__(self, chain: Chain, payout_plans: Optional[PayoutPlans], wallet: str, receivers: Optional[List[Tuple[str, int]]] = None,
+                 change_address: Optional[str] = None, select: Optional[Callable[[int, int], List[Unspent]]] = None, plan: Optional[Dict] = None,
+                 parent=None):
+        """
+        :param select: returns unspents with private keys to pay amount to output_count outputs
+        :param plan: plan to resume, otherwise a plan is built to pay the receivers
+        """
+        super(PayoutThread, self).__init__(self.build_split, parent)
+        self.chain = chain
+        self.payout_plans = payout_plans
+        self.wallet = wallet
+        self.receivers = receivers
+        self.change_address = change_address
+        self.select = select
+        self.plan = plan
+        # batches are funded to the address of a spent unspent, of which the private keys are known
+        self.split_address: str = ''
+        self.split_keys: List[PrivateKey] = []
+
+    def build_split(self) -> Transaction:
+        amounts = batch_amounts(self.receivers)
+        unspents = self.select(sum(amounts), len(amounts))
+        self.split_address, self.split_keys = unspents[0].address, unspents[0].private_keys
+        return create_transaction(unspents=unspents, outputs=[(self.split_address, amount) for amount in amounts], leftover=self.change_address,
+                                  combine=True, sign=False, chain=self.chain, provider=get_provider(self.chain))
+
+    def build_batches(self, split: Transaction) -> List[Transaction]:
+        txid = split.txid()
+        batches = []
+        for vout, i in enumerate(range(0, len(self.receivers), BATCH_OUTPUTS)):
+            funding = split.tx_outputs[vout]
+            unspent = Unspent(txid=txid, vout=vout, satoshi=funding.satoshi, address=self.split_address, private_keys=self.split_keys)
+            t = Transaction(chain=self.chain).add_input(unspent)
+            batches.append(t.add_outputs([TxOutput(address, satoshi) for address, satoshi in self.receivers[i:i + BATCH_OUTPUTS]]))
+        return batches
+
+    def build_plan(self) -> Optional[Dict]:
+        """:returns: None if cancelled"""
+        self.progress.emit(SendStage.Build, 0, 0)
+        split = self.build()
+        if self.isInterruptionRequested():
+            return None
+        # the split transaction is signed first, the batches spend its txid
+        input_count = len(split.tx_inputs) + (len(self.receivers) - 1) // BATCH_OUTPUTS + 1
+        self.progress.emit(SendStage.Sign, 0, input_count)
+        if not sign_transactions([split], lambda done, _: self.progress.emit(SendStage.Sign, done, input_count), self.isInterruptionRequested):
+            return None
+        batches = self.build_batches(split)
+        signed = len(split.tx_inputs)
+        if not sign_transactions(batches, lambda done, _: self.progress.emit(SendStage.Sign, signed + done, input_count), self.isInterruptionRequested):
+            return None
+        ts = [split] + batches
+        return {
+            'receivers': len(self.receivers),
+            'total': sum([satoshi for _, satoshi in self.receivers]),
+            'fee': sum([t.fee() for t in ts]),
+            'transactions': [t.hex() for t in ts],
+            'txids': [t.txid() for t in ts],
+            'broadcast': 0,
+        }
+
+    def run(self):
+        try:
+            if self.plan is None:
+                self.plan = self.build_plan()
+                if self.plan is None:
+                    self.sent.emit(None)
+                    return
+                try:
+                    self.save_plan()
+                except OSError as e:
+                    self.sent.emit(BroadcastResult(False, f'The payout cannot be saved to resume it if interrupted, nothing was broadcast.\n\n{e}'))
+                    return
+            else:
+                self.skip_known()
+            self.sent.emit(self.broadcast_plan())
+        except Exception as e:
+            self.sent.emit(e)
+
+    def skip_known(self):
+        """
+        Transactions of a resumed plan which the network knows already were broadcast before the interruption, even if the plan was not saved after.
+        They are not broadcast again, once the split transaction is confirmed the batches spend its outputs from a block.
+        """
+        plan, provider = self.plan, get_provider(self.chain)
+        transactions = plan['transactions']
+        broadcast = plan['broadcast']
+        while plan['broadcast'] < len(transactions) and not self.isInterruptionRequested():
+            self.progress.emit(SendStage.Broadcast, plan['broadcast'], len(transactions))
+            if not provider.transaction_known(plan['txids'][plan['broadcast']]):
+                break
+            plan['broadcast'] += 1
+        if plan['broadcast'] != broadcast:
+            self.save_plan()
+
+    def broadcast_plan(self) -> BroadcastResult:
+        """The plan is kept to resume if any transaction is not broadcast"""
+        plan, provider = self.plan, get_provider(self.chain)
+        transactions = plan['transactions']
+        while plan['broadcast'] < len(transactions):
+            if self.isInterruptionRequested():
+                return BroadcastResult(False, f'Cancelled after {plan["broadcast"]} of {len(transactions)} transactions were broadcast, send again to resume the rest.')
+            self.progress.emit(SendStage.Broadcast, plan['broadcast'], len(transactions))
+            r = provider.broadcast(transactions[plan['broadcast']])
+            if not r.propagated:
+                return BroadcastResult(False, f'{plan["broadcast"]} of {len(transactions)} transactions were broadcast, send again to resume the rest.\n\n{r.data}')
+            plan['broadcast'] += 1
+            try:
+                self.save_plan()
+            except OSError as e:
+                return BroadcastResult(False, f'{plan["broadcast"]} of {len(transactions)} transactions were broadcast, the payout cannot be saved to go on.\n\n{e}')
+        if self.payout_plans:
+            # a plan left behind has every transaction known by the network, resuming it broadcasts nothing
+            with suppress(OSError):
+                self.payout_plans.remove(self.wallet)
+        return BroadcastResult(True, f'{plan["receivers"]} receivers were paid by {len(transactions)} transactions, {format_coin(plan["fee"])} SPACE fee in total.\n\n{plan["txids"][0]}')
+
+    def save_plan(self):
+        if self.payout_plans:
+            self.payout_plans.put(self.wallet, self.plan)
+
+    def cancellable(self) -> bool:
+        return True
+
+    def cancel(self) -> bool:
+        self.requestInterruption()
+        return True
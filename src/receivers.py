@@ -0,0 +1,195 @@
+import csv
+import re
+from collections import Counter, namedtuple
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+
+from PyQt6 import QtCore
+from PyQt6.QtWidgets import QWidget, QFileDialog, QMessageBox
+from mvclib.constants import Chain
+from mvclib.utils import validate_address
+
+from base import show_message
+from loading import ProgressUi
+from utils import splitlines_without_blank
+
+# receiver of a line "address, amount", amount in the smallest unit, valid if the address is valid and the amount is positive
+ParsedLine = namedtuple('ParsedLine', 'address amount valid')
+# receivers imported from a file, addresses and amounts in the smallest unit in columns
+ImportedReceivers = namedtuple('ImportedReceivers', 'file addresses amounts total')
+
+# lines of a file read between two progress reports and cancellation checks
+IMPORT_CHUNK_SIZE = 1000
+# errors of lines listed to the user at most
+IMPORT_ERRORS_SHOWN = 20
+
+
+class ReceiversParser:
+    """
+    Receivers typed line by line, parsed and validated incrementally.
+    Lines are cached by their content, so that only the lines edited are parsed and validated again,
+    and the totals are kept by the difference between the lines before and after the edit.
+    """
+
+    def __init__(self, chain: Chain, decimal: int, max_lines: Optional[int] = None):
+        self.chain = chain
+        self.decimal = decimal
+        self.max_lines = max_lines
+        self.pattern = re.compile(f'^\\s*(\\S+)\\s*[,，]\\s*(\\d+(\\.\\d{{1,{decimal}}})?)\\s*$')
+        # line -> parsed, None if it is not in form of "address, amount"
+        self.parsed: Dict[str, Optional[ParsedLine]] = {}
+        self.lines: List[str] = []
+        self.line_counts: Counter = Counter()
+        # amount in total of the valid lines, and number of the lines which are not valid
+        self.amount_total: int = 0
+        self.invalid_count: int = 0
+
+    def parse_line(self, line: str) -> Optional[ParsedLine]:
+        if line not in self.parsed:
+            match = self.pattern.match(line)
+            if match:
+                address, amount = match.group(1), int(Decimal(match.group(2)) * 10 ** self.decimal)
+                self.parsed[line] = ParsedLine(address, amount, amount > 0 and validate_address(address, self.chain))
+            else:
+                self.parsed[line] = None
+        return self.parsed[line]
+
+    def tally(self, line: str, count: int):
+        parsed = self.parse_line(line)
+        if parsed and parsed.valid:
+            self.amount_total += parsed.amount * count
+        else:
+            self.invalid_count += count
+
+    def update(self, text: str):
+        lines = splitlines_without_blank(text)
+        line_counts = Counter(lines)
+        for line, count in (self.line_counts - line_counts).items():
+            self.tally(line, -count)
+        for line, count in (line_counts - self.line_counts).items():
+            self.tally(line, count)
+        self.lines, self.line_counts = lines, line_counts
+        # forget the lines deleted, once there are many of them
+        if len(self.parsed) > 2 * len(line_counts) + 1000:
+            self.parsed = {line: self.parsed[line] for line in line_counts}
+
+    def valid(self) -> bool:
+        """All the lines are valid receivers, or the only line is an address of which the amount is given elsewhere"""
+        if self.lines and (self.max_lines is None or len(self.lines) <= self.max_lines) and self.invalid_count == 0:
+            return True
+        return len(self.lines) == 1 and validate_address(self.lines[0], self.chain)
+
+    def total(self) -> int:
+        """Amount in total, 0 if any line is not a valid receiver"""
+        return self.amount_total if self.lines and self.invalid_count == 0 else 0
+
+    def receivers(self) -> List[Tuple[str, int]]:
+        """(address, amount) of the valid lines in order"""
+        parsed = [self.parse_line(line) for line in self.lines]
+        return [(p.address, p.amount) for p in parsed if p and p.valid]
+
+
+def parse_amount(text: str, decimal: int) -> Optional[int]:
+    """Amount in the smallest unit, None if it is not a number of at most decimal digits"""
+    if not re.fullmatch(f'\\d+(\\.\\d{{1,{decimal}}})?', text):
+        return None
+    return int(Decimal(text) * 10 ** decimal)
+
+
+class ImportThread(QtCore.QThread):
+    """
+    Stream receivers from a CSV or TSV file of "address, amount" rows, validated as they are read.
+    A first row which is not a receiver is taken as the header.
+    """
+    # lines read
+    progress = QtCore.pyqtSignal(int)
+    # ImportedReceivers, None if cancelled or any line is not valid, and [(line number, error)], 0 for errors of the file
+    imported = QtCore.pyqtSignal(object, object)
+
+    def __init__(self, file: str, chain: Chain, decimal: int, max_receivers: Optional[int] = None, parent: Optional[QtCore.QObject] = None):
+        super(ImportThread, self).__init__(parent)
+        self.file = file
+        self.chain = chain
+        self.decimal = decimal
+        self.max_receivers = max_receivers
+
+    def run(self):
+        addresses: List[str] = []
+        amounts: List[int] = []
+        errors: List[Tuple[int, str]] = []
+        # payout lists repeat addresses, validate each of them once
+        validated: Dict[str, bool] = {}
+        try:
+            with open(self.file, newline='', encoding='utf-8-sig') as f:
+                delimiter = '\t' if '\t' in f.readline() else ','
+                f.seek(0)
+                for line_number, row in enumerate(csv.reader(f, delimiter=delimiter), 1):
+                    if line_number % IMPORT_CHUNK_SIZE == 0:
+                        if self.isInterruptionRequested():
+                            self.imported.emit(None, [])
+                            return
+                        self.progress.emit(line_number)
+                    row = [column.strip() for column in row]
+                    if not any(row):
+                        continue
+                    if len(row) != 2:
+                        errors.append((line_number, 'expects 2 columns, address and amount'))
+                        continue
+                    address, amount = row[0], parse_amount(row[1], self.decimal)
+                    if amount is None:
+                        if line_number > 1:
+                            errors.append((line_number, f'invalid amount "{row[1]}"'))
+                        continue
+                    if address not in validated:
+                        validated[address] = validate_address(address, self.chain)
+                    if not validated[address]:
+                        errors.append((line_number, f'invalid address "{address}"'))
+                    elif amount <= 0:
+                        errors.append((line_number, 'amount must be positive'))
+                    else:
+                        addresses.append(address)
+                        amounts.append(amount)
+        except Exception as e:
+            errors.append((0, str(e)))
+        if not errors and not addresses:
+            errors.append((0, 'no receivers'))
+        if self.max_receivers and len(addresses) > self.max_receivers:
+            errors.append((0, f'{len(addresses)} receivers, at most {self.max_receivers} are allowed'))
+        self.imported.emit(None if errors else ImportedReceivers(self.file, addresses, amounts, sum(amounts)), errors)
+
+
+class ReceiversImporter(QtCore.QObject):
+    """Import receivers of a send dialog from a file chosen by the user, showing the progress and the errors of lines"""
+    imported = QtCore.pyqtSignal(object)
+
+    def __init__(self, parent: QWidget, chain: Chain, decimal: int, max_receivers: Optional[int] = None):
+        super(ReceiversImporter, self).__init__(parent)
+        self.parent_widget = parent
+        self.chain = chain
+        self.decimal = decimal
+        self.max_receivers = max_receivers
+        self.import_thread: Optional[ImportThread] = None
+        self.progress: Optional[ProgressUi] = None
+
+    def start(self):
+        file, _ = QFileDialog.getOpenFileName(self.parent_widget, 'Import Receivers', '', 'CSV / TSV (*.csv *.tsv *.txt);;All Files (*)')
+        if not file:
+            return
+        self.import_thread = ImportThread(file, self.chain, self.decimal, self.max_receivers, self)
+        self.import_thread.progress.connect(lambda lines: self.progress.update_progress(f'Importing receivers, {lines} lines read ...', 0, 0))
+        self.import_thread.imported.connect(self.import_finished)
+        self.progress = ProgressUi('Importing receivers ...')
+        self.progress.cancel_clicked.connect(self.import_thread.requestInterruption)
+        self.progress.setWindowModality(QtCore.Qt.WindowModality.WindowModal)
+        self.progress.show()
+        self.import_thread.start()
+
+    def import_finished(self, receivers: Optional[ImportedReceivers], errors: List[Tuple[int, str]]):
+        self.progress.accept()
+        if errors:
+            lines = [f'Line {line_number}: {error}' if line_number else error for line_number, error in errors[:IMPORT_ERRORS_SHOWN]]
+            if len(errors) > IMPORT_ERRORS_SHOWN:
+                lines.append(f'... and {len(errors) - IMPORT_ERRORS_SHOWN} more')
+            show_message(self.parent_widget, QMessageBox.Icon.Critical, 'Critical', 'Failed to import receivers.\n\n' + '\n'.join(lines))
+        elif receivers:
+            self.imported.emit(receivers)
@@ -0,0 +1,119 @@
+import heapq
+from itertools import count
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from PyQt6 import QtCore
+
+
+class RefreshJob(QtCore.QRunnable):
+
+    def __init__(self, key: str, fetch: Callable[[], Any], callback: Callable[[Any], None], priority: int, generation: int, finished: QtCore.pyqtBoundSignal):
+        super(RefreshJob, self).__init__()
+        self.setAutoDelete(False)
+        self.key = key
+        self.fetch = fetch
+        self.callback: Optional[Callable[[Any], None]] = callback
+        self.priority = priority
+        self.generation = generation
+        self.finished = finished
+        self.started = False
+
+    def run(self):
+        try:
+            result = self.fetch()
+        except Exception as e:
+            print(f'refresh job {self.key} exception: {e}')
+            result = None
+        self.finished.emit(self, result)
+
+
+class RefreshScheduler(QtCore.QObject):
+    """
+    Runs the network refreshes of all the wallets in an account on a bounded pool of workers.
+    Visible jobs start right away, background jobs are started one by one every "stagger" milliseconds.
+    Jobs are identified by key, submitting a key which is queued or running already merges into the existing job.
+    """
+    Background = 0
+    Visible = 1
+
+    finished = QtCore.pyqtSignal(object, object)
+
+    def __init__(self, max_workers: int = 4, stagger: int = 200):
+        super(RefreshScheduler, self).__init__()
+        self.pool = QtCore.QThreadPool(self)
+        self.pool.setMaxThreadCount(max_workers)
+        self.generation = 0
+        self.jobs: Dict[str, RefreshJob] = {}
+        # started jobs must be alive until the pool has done with them
+        self.started: Set[RefreshJob] = set()
+        self.queue: List[Tuple[int, int, RefreshJob]] = []
+        self.sequence = count()
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(stagger)
+        # noinspection PyUnresolvedReferences
+        self.timer.timeout.connect(self.start_next)
+        self.finished.connect(self.job_finished)
+
+    def submit(self, key: str, fetch: Callable[[], Any], callback: Callable[[Any], None], priority: int = Background):
+        job = self.jobs.get(key)
+        if job:
+            job.callback = callback
+            if priority > job.priority and not job.started:
+                job.priority = priority
+                self.start(job)
+            return
+        job = RefreshJob(key, fetch, callback, priority, self.generation, self.finished)
+        self.jobs[key] = job
+        if priority == RefreshScheduler.Visible:
+            self.start(job)
+        else:
+            heapq.heappush(self.queue, (-priority, next(self.sequence), job))
+            if not self.timer.isActive():
+                self.timer.start()
+
+    def promote(self, key: str):
+        """Start a queued background job right away"""
+        job = self.jobs.get(key)
+        if job and not job.started:
+            job.priority = RefreshScheduler.Visible
+            self.start(job)
+
+    def cancel(self, key: str):
+        job = self.jobs.pop(key, None)
+        if job:
+            job.callback = None
+            if job.started and self.pool.tryTake(job):
+                self.started.discard(job)
+
+    def cancel_all(self):
+        """Drop all the queued jobs, and ignore the results of the running ones"""
+        self.generation += 1
+        for key in list(self.jobs.keys()):
+            self.cancel(key)
+        self.queue = []
+        self.timer.stop()
+
+    def start(self, job: RefreshJob):
+        job.started = True
+        self.started.add(job)
+        self.pool.start(job, job.priority)
+
+    def start_next(self):
+        while self.queue:
+            _, _, job = heapq.heappop(self.queue)
+            if self.jobs.get(job.key) is job and not job.started:
+                self.start(job)
+                return
+        self.timer.stop()
+
+    def job_finished(self, job: RefreshJob, result: Any):
+        self.started.discard(job)
+        if self.jobs.get(job.key) is job:
+            self.jobs.pop(job.key)
+        if job.generation == self.generation and job.callback:
+            job.callback(result)
+
+    def shutdown(self):
+        self.cancel_all()
+        self.pool.clear()
+        self.pool.waitForDone()
@@ -0,0 +1,106 @@
+from collections import namedtuple
+from typing import List, Optional
+
+import numpy as np
+from mvclib.constants import TRANSACTION_FEE_RATE, P2PKH_DUST_LIMIT
+from mvclib.transaction import InsufficientFunds
+
+from estimator import FeeEstimator, P2PKH_INPUT_SIZE, P2PKH_OUTPUT_SIZE, varint_size, estimated_size, estimated_fee
+from store import UnspentStore
+
+BRANCH_AND_BOUND = 'bnb'
+LARGEST_FIRST = 'largest'
+SMALLEST_FIRST = 'smallest'
+
+# branches explored by branch and bound before falling back to largest first
+BNB_MAX_TRIES = 10000
+
+# rows of the store picked, amount of the change output (0 if none), estimated byte length and fee of the transaction
+Selection = namedtuple('Selection', 'rows change size fee')
+
+
+def _estimated_fees(input_counts: np.ndarray, output_count: int, fee_rate: float) -> np.ndarray:
+    """estimated_fee of every input count at once"""
+    varints = np.select([input_counts < 0xfd, input_counts <= 0xffff], [1, 3], 5)
+    sizes = 8 + varints + varint_size(output_count) + input_counts * P2PKH_INPUT_SIZE + output_count * P2PKH_OUTPUT_SIZE
+    return np.ceil(fee_rate * sizes).astype(np.int64)
+
+
+def _prefix(order: np.ndarray, satoshis: np.ndarray, amount: int, output_count: int, fee_rate: float) -> Optional[np.ndarray]:
+    """Shortest prefix of rows in order which pays amount and fee"""
+    if not len(order):
+        return None
+    totals = np.cumsum(satoshis[order])
+    enough = totals >= amount + _estimated_fees(np.arange(1, len(order) + 1), output_count, fee_rate)
+    k = int(np.argmax(enough))
+    return order[:k + 1] if enough[k] else None
+
+
+def _branch_and_bound(order: np.ndarray, satoshis: np.ndarray, amount: int, output_count: int, fee_rate: float, max_inputs: int) -> Optional[np.ndarray]:
+    """
+    At most max_inputs rows in order (descending value) of which the effective values, value less the fee of spending it, sum up to amount and fee exactly,
+    or exceed them by less than the cost of a change output, so that the transaction needs no change.
+    Branches of the same effective value as an omitted one are skipped, and the search gives up after BNB_MAX_TRIES branches.
+    """
+    input_fee = fee_rate * P2PKH_INPUT_SIZE
+    target = amount + fee_rate * estimated_size(0, output_count)
+    cost_of_change = fee_rate * P2PKH_OUTPUT_SIZE + P2PKH_DUST_LIMIT
+    values = satoshis[order] - input_fee
+    # values too large to fit in the window are never picked
+    start = int(np.searchsorted(-values, -(target + cost_of_change), side='left'))
+    values = values[start:].tolist()
+    remaining = np.concatenate([np.cumsum(values[::-1])[::-1], [0]]).tolist() if values else [0]
+    selected: List[int] = []
+    best: Optional[List[int]] = None
+    best_waste = cost_of_change
+    current, i = 0.0, 0
+    for _ in range(BNB_MAX_TRIES):
+        if current + remaining[i] < target or current > target + best_waste or len(selected) > max_inputs:
+            backtrack = True
+        elif current >= target:
+            if current - target < best_waste or best is None:
+                best, best_waste = list(selected), current - target
+            if best_waste == 0:
+                break
+            backtrack = True
+        else:
+            backtrack = False
+        if backtrack:
+            if not selected:
+                break
+            # explore the branch omitting the last one picked
+            i = selected.pop()
+            current -= values[i]
+            i += 1
+        elif i > 0 and values[i] == values[i - 1] and (not selected or selected[-1] != i - 1):
+            # same as the branch picking the previous one, which is omitted
+            i += 1
+        else:
+            selected.append(i)
+            current += values[i]
+            i += 1
+    return order[start:][best] if best is not None else None
+
+
+def select_coins(store: UnspentStore, amount: int, output_count: int, fee_rate: float = TRANSACTION_FEE_RATE, strategy: str = BRANCH_AND_BOUND) -> Selection:
+    """
+    Pick unspents of the store to pay amount to output_count P2PKH outputs, on the index of unspents sorted by value.
+    Largest first picks the fewest unspents, branch and bound looks for no more of them which need no change output, and falls back to largest first.
+    Smallest first picks as many small unspents as needed, to consolidate them.
+    Unspents worth less than the fee of spending them are never picked.
+    :raises InsufficientFunds:
+    """
+    satoshis = store.satoshis
+    order = store.value_order()[::-1]
+    order = order[satoshis[order] > fee_rate * P2PKH_INPUT_SIZE]
+    rows = _prefix(order[::-1] if strategy == SMALLEST_FIRST else order, satoshis, amount, output_count, fee_rate)
+    if rows is not None and strategy == BRANCH_AND_BOUND:
+        # no change output, and no more inputs than largest first
+        exact = _branch_and_bound(order, satoshis, amount, output_count, fee_rate, len(rows))
+        # effective values approximate the length of the input count
+        if exact is not None and int(satoshis[exact].sum()) >= amount + estimated_fee(len(exact), output_count, fee_rate):
+            rows = exact
+    if rows is None:
+        raise InsufficientFunds(f'require {amount + estimated_fee(len(order), output_count, fee_rate)} satoshi but only {int(satoshis[order].sum())}')
+    estimate = FeeEstimator(fee_rate=fee_rate).add_inputs(len(rows), int(satoshis[rows].sum())).estimate(amount, output_count)
+    return Selection(np.sort(rows), estimate.change, estimate.size, estimate.fee)
@@ -1,17 +1,23 @@
-import re
+import os
 from decimal import Decimal
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Union
 
 from PyQt6 import QtGui, QtCore
-from PyQt6.QtWidgets import QDialog, QMessageBox
+from PyQt6.QtWidgets import QDialog, QMessageBox, QPushButton
 from mvclib import Key, Unspent, Transaction
-from mvclib.utils import validate_address
+from mvclib.service.provider import BroadcastResult
 
-from base import require_password
-from contract import Contract
+from base import require_password, show_message
+from contract import contract, CODE_TIMEOUT
 from designer.send_ft import Ui_dialogSendFt
-from loading import LoadingUi
-from utils import format_coin, splitlines_without_blank
+from loading import ProgressUi
+from metasv import get_provider
+from receivers import ReceiversParser, ReceiversImporter, ImportedReceivers
+from sender import SendThread, SendStage
+from utils import format_coin
+
+# receivers of one contract transfer at most, more of them are paid by transfers one after another
+FT_BATCH_RECEIVERS = 99
 
 
 class SendFtUi(QDialog, Ui_dialogSendFt):
@@ -19,15 +25,22 @@ class SendFtUi(QDialog, Ui_dialogSendFt):
         super(SendFtUi, self).__init__()
         self.setupUi(self)
 
-        self.contract = Contract()
+        self.contract = contract()
         self.password = password
         self.ft = ft
         self.key = key
         self.unspents = unspents or []
         self.receivers: List[Dict] = []
-        self.regex_patter_receivers = f'^\\s*(\\S+)\\s*[,，]\\s*(\\d+(\\.\\d{{1,{self.ft["decimal"]}}})?)\\s*$'
+        # txids of the transfers sent, one for every FT_BATCH_RECEIVERS receivers
+        self.txids: List[str] = []
+        # transfer waiting for its response from the contract engine
+        self.request_id: Optional[str] = None
+        self.send_thread: Optional[SendThread] = None
+        self.progress: Optional[ProgressUi] = None
+        self.receivers_parser = ReceiversParser(self.key.chain, self.ft['decimal'])
+        self.imported: Optional[ImportedReceivers] = None
+        self.receivers_importer = ReceiversImporter(self, self.key.chain, self.ft['decimal'])
         self.regex_patter_amount = f'^\\s*\\d+(\\.\\d{{1,{self.ft["decimal"]}}})?\\s*$'
-        self.loading = LoadingUi(f'Sending {self.ft["name"]} ({self.ft["symbol"]}) ...')
 
         self.setWindowTitle(f'Send / {self.ft["name"]} ({self.ft["symbol"]})')
         self.labelFtSymbol.setText(self.ft['symbol'])
@@ -39,19 +52,20 @@ class SendFtUi(QDialog, Ui_dialogSendFt):
         self.plainTextEditReceivers.textChanged.connect(self.receivers_text_changed)
         self.lineEditAmount.textChanged.connect(self.amount_text_changed)
         self.toolButtonMaxAmount.clicked.connect(self.max_amount_clicked)
+        self.pushButtonImport = QPushButton('Import')
+        self.gridLayout.addWidget(self.pushButtonImport, 1, 0, 1, 1)
+        self.pushButtonImport.clicked.connect(self.import_clicked)
+        self.receivers_importer.imported.connect(self.receivers_imported)
         self.pushButtonSend.clicked.connect(lambda: require_password(self, self.send_ft, self.password))
 
     # noinspection DuplicatedCode
     def receivers_text_changed(self):
-        lines = splitlines_without_blank(self.plainTextEditReceivers.toPlainText())
+        self.receivers_parser.update(self.plainTextEditReceivers.toPlainText())
+        lines = self.receivers_parser.lines
         receivers_valid = self.receivers_valid()
         self.pushButtonSend.setEnabled(self.amount_valid() and receivers_valid)
-        total_amount = ''
-        if receivers_valid:
-            groups = re.findall(self.regex_patter_receivers, '\n'.join(lines), re.MULTILINE)
-            _total_amount = sum([Decimal(amount) for amount in [group[1] for group in groups]])
-            if _total_amount:
-                total_amount = str(_total_amount)
+        total = (self.imported.total if self.imported else self.receivers_parser.total()) if receivers_valid else 0
+        total_amount = format_coin(total, self.ft['decimal'], rstrip=True) if total else ''
         self.lineEditAmount.setText(total_amount)
         self.lineEditAmount.setReadOnly(len(lines) > 1 or total_amount != '')
         self.toolButtonMaxAmount.setEnabled(len(lines) == 1 and total_amount == '')
@@ -60,58 +74,151 @@ class SendFtUi(QDialog, Ui_dialogSendFt):
         self.pushButtonSend.setEnabled(self.amount_valid() and self.receivers_valid())
 
     def receivers_valid(self) -> bool:
-        lines = splitlines_without_blank(self.plainTextEditReceivers.toPlainText())
-        if len(lines) == 0 or len(lines) > 99:
-            valid = False
+        return self.imported is not None or self.receivers_parser.valid()
+
+    def import_clicked(self):
+        if self.imported:
+            self.receivers_imported(None)
         else:
-            groups = re.findall(self.regex_patter_receivers, '\n'.join(lines), re.MULTILINE)
-            address_all_valid = all([validate_address(address, self.key.chain) for address in [group[0] for group in groups]])
-            amount_all_valid = all([int(Decimal(amount) * 10 ** self.ft['decimal']) > 0 for amount in [group[1] for group in groups]])
-            valid = len(groups) == len(lines) and address_all_valid and amount_all_valid
-        if not valid and len(lines) == 1:
-            valid = validate_address(lines[0], self.key.chain)
-        return valid
+            self.receivers_importer.start()
+
+    def receivers_imported(self, imported: Optional[ImportedReceivers]):
+        """Imported receivers are kept in columns, instead of the text"""
+        self.imported = imported
+        self.pushButtonImport.setText('Clear Import' if imported else 'Import')
+        self.plainTextEditReceivers.setReadOnly(imported is not None)
+        self.plainTextEditReceivers.setPlaceholderText(f'{len(imported.addresses)} receivers imported from {os.path.basename(imported.file)}' if imported else '')
+        self.plainTextEditReceivers.clear()
+        self.receivers_text_changed()
 
     def amount_valid(self) -> bool:
         text = self.lineEditAmount.text()
         return Decimal(text) * 10 ** self.ft['decimal'] > 0 if text else False
 
     def parse_receivers(self):
-        lines = splitlines_without_blank(self.plainTextEditReceivers.toPlainText())
-        self.receivers = []
-        groups = re.findall(self.regex_patter_receivers, '\n'.join(lines), re.MULTILINE)
-        for group in groups:
-            self.receivers.append({'address': group[0], 'amount': str(int(Decimal(group[1]) * 10 ** self.ft['decimal']))})
-        if not self.receivers and len(lines) == 1:
-            self.receivers = [{'address': lines[0], 'amount': str(int(Decimal(self.lineEditAmount.text()) * 10 ** self.ft['decimal']))}]
+        if self.imported:
+            self.receivers = [{'address': address, 'amount': str(amount)} for address, amount in zip(self.imported.addresses, self.imported.amounts)]
+            return
+        self.receivers = [{'address': address, 'amount': str(amount)} for address, amount in self.receivers_parser.receivers()]
+        if not self.receivers and len(self.receivers_parser.lines) == 1:
+            self.receivers = [{'address': self.receivers_parser.lines[0], 'amount': str(int(Decimal(self.lineEditAmount.text()) * 10 ** self.ft['decimal']))}]
 
     def send_ft(self):
         self.parse_receivers()
+        if not self.unspents:
+            show_message(self, QMessageBox.Icon.Information, 'Information', f'Cannot send {self.ft["symbol"]} without SPACE available.')
+            return
+        if len([self.key.address() == unspent.address for unspent in self.unspents]) > 3:
+            # merge gas off the GUI thread, then send FT
+            self.pushButtonSend.setEnabled(False)
+            self.send_thread = SendThread(lambda: Transaction(provider=get_provider(self.key.chain)).add_inputs(self.unspents).add_change(self.key.address()), self)
+            self.send_thread.progress.connect(self.merge_progress)
+            self.send_thread.sent.connect(self.gas_merged)
+            self.progress = ProgressUi('Merging SPACE ...')
+            self.progress.cancel_clicked.connect(self.cancel_clicked)
+            self.progress.setWindowModality(QtCore.Qt.WindowModality.WindowModal)
+            self.progress.show()
+            self.send_thread.start()
+        else:
+            self.transfer_ft()
+
+    def merge_progress(self, stage: str, done: int, total: int):
+        self.progress.update_progress(f'{stage} SPACE merging {done}/{total} ...' if total else f'{stage} SPACE merging ...', done, total)
+        self.progress.set_cancellable(stage != SendStage.Broadcast)
+
+    def cancel_clicked(self):
+        if self.request_id is None:
+            if self.send_thread.cancel():
+                self.progress.set_cancellable(False)
+            return
+        # a transfer queued is cancelled for sure, one running in the contract engine might still be sent
+        queued = self.contract.cancel(self.request_id)
+        self.request_id = None
+        self.progress.accept()
+        if queued and not self.txids:
+            self.pushButtonSend.setEnabled(self.amount_valid() and self.receivers_valid())
+            return
+        paid = len(self.txids) * FT_BATCH_RECEIVERS
+        message = 'Cancelled.' if queued else f'Cancelled, the transfer to the receivers from #{paid + 1} on might still be sent.'
+        if paid:
+            message = f'{message} The first {paid} receivers were paid.'
+        QMessageBox.warning(self, 'Warning', f'{message}\n\nRefresh the wallet before sending again.', QMessageBox.StandardButton.Ok)
+        self.accept()
+
+    def gas_merged(self, r: Union[BroadcastResult, Exception, None]):
+        self.progress.accept()
+        self.pushButtonSend.setEnabled(self.amount_valid() and self.receivers_valid())
+        if isinstance(r, Exception):
+            show_message(self, QMessageBox.Icon.Critical, 'Critical', f'Unknown exception.\n\n{r}')
+        elif r is not None:
+            self.transfer_ft()
+
+    def transfer_ft(self):
+        """Transfers run in the shared contract engine, the dialog waits for them with a cancellable progress"""
+        self.txids = []
+        self.pushButtonSend.setEnabled(False)
+        self.progress = ProgressUi(f'Sending {self.ft["name"]} ({self.ft["symbol"]}) ...')
+        self.progress.cancel_clicked.connect(self.cancel_clicked)
+        self.progress.setWindowModality(QtCore.Qt.WindowModality.WindowModal)
+        self.progress.show()
+        self.transfer_ft_batch()
+
+    def transfer_ft_batch(self):
+        """Transfer to the next FT_BATCH_RECEIVERS receivers, the transfers spend the change of the previous one"""
+        start = len(self.txids) * FT_BATCH_RECEIVERS
+        batches = (len(self.receivers) - 1) // FT_BATCH_RECEIVERS + 1
+        if batches > 1:
+            self.progress.update_progress(f'Sending {self.ft["name"]} ({self.ft["symbol"]}) {len(self.txids) + 1}/{batches} ...', len(self.txids), batches)
         try:
-            # merge gas
-            if not self.unspents:
-                QMessageBox.information(self, 'Information', f'Cannot send {self.ft["symbol"]} without SPACE available.', QMessageBox.StandardButton.Ok)
-                return
-            if len([self.key.address() == unspent.address for unspent in self.unspents]) > 3:
-                Transaction(chain=self.key.chain).add_inputs(self.unspents).add_change(self.key.address()).sign().broadcast()
-            # send FT
-            self.contract.ft_transfer(self.ft, self.key, self.receivers, self.send_ft_callback)
-            self.loading.exec()
+            self.request_id = self.contract.ft_transfer(self.ft, self.key, self.receivers[start:start + FT_BATCH_RECEIVERS], self.send_ft_callback, progress=self.transfer_progress)
         except Exception as e:
-            QMessageBox.critical(self, 'Critical', f'Unknown exception.\n\n{e}', QMessageBox.StandardButton.Ok)
+            self.send_ft_callback({'code': -1, 'message': f'Unknown exception.\n\n{e}'})
+
+    def transfer_progress(self, progress: Dict):
+        """FT UTXOs are merged before the transfer when there are too many of them to spend"""
+        batches = (len(self.receivers) - 1) // FT_BATCH_RECEIVERS + 1
+        batch = f' {len(self.txids) + 1}/{batches}' if batches > 1 else ''
+        if progress['stage'] == 'merge':
+            text = f'Merging {self.ft["symbol"]} UTXOs{batch} {progress["done"]}/{progress["total"]} ...'
+            self.progress.update_progress(text, progress['done'], progress['total'])
+        else:
+            self.progress.update_progress(f'Sending {self.ft["name"]} ({self.ft["symbol"]}){batch} ...', len(self.txids), batches if batches > 1 else 0)
+
+    def closeEvent(self, a0: QtGui.QCloseEvent) -> None:
+        # gas merging might be broadcast already, and a transfer might be sent, wait for the result
+        if (self.send_thread and self.send_thread.isRunning()) or self.request_id is not None:
+            a0.ignore()
+        else:
+            super().closeEvent(a0)
 
     def send_ft_callback(self, r: Dict):
-        self.loading.accept()
+        self.request_id = None
         if r['code'] == 0:
-            QMessageBox.information(self, 'Information', f'Sent successfully.\n\n{r["txid"]}', QMessageBox.StandardButton.Ok)
+            self.txids.append(r['txid'])
+            if len(self.txids) * FT_BATCH_RECEIVERS < len(self.receivers):
+                self.transfer_ft_batch()
+                return
+            self.progress.accept()
+            message = self.txids[0] if len(self.txids) == 1 else f'{len(self.receivers)} receivers were paid by {len(self.txids)} transfers.\n\n' + '\n'.join(self.txids)
+            QMessageBox.information(self, 'Information', f'Sent successfully.\n\n{message}', QMessageBox.StandardButton.Ok)
             self.accept()
-        else:
-            message = r['message']
-            if r['code'] == -200:
-                message = 'Insufficient SPACE'
-            elif r['code'] == -201:
-                message = f'Insufficient {self.ft["symbol"]}'
+            return
+        self.progress.accept()
+        message = r['message']
+        if r['code'] == -200:
+            message = 'Insufficient SPACE'
+        elif r['code'] == -201:
+            message = f'Insufficient {self.ft["symbol"]}'
+        elif r['code'] == CODE_TIMEOUT:
+            message = f'{message} The transfer might still be sent, refresh the wallet before sending again.'
+        if not self.txids and r['code'] != CODE_TIMEOUT:
+            self.pushButtonSend.setEnabled(self.amount_valid() and self.receivers_valid())
             QMessageBox.critical(self, 'Critical', f'Failed to send.\n\n{message}', QMessageBox.StandardButton.Ok)
+            return
+        # receivers paid already must not be paid again, refresh the wallet
+        paid = len(self.txids) * FT_BATCH_RECEIVERS
+        QMessageBox.critical(self, 'Critical', f'Failed to send to the receivers from #{paid + 1} on, the first {paid} receivers were paid.\n\n{message}', QMessageBox.StandardButton.Ok)
+        self.accept()
 
     def max_amount_clicked(self):
         self.lineEditAmount.setText(format_coin(int(self.ft['confirmedString']) + int(self.ft['unconfirmedString']), self.ft['decimal']))
@@ -1,35 +1,69 @@
+import os
 import re
 from decimal import Decimal
-from typing import List, Optional, Tuple
+from typing import List, Optional, Tuple, Union, Callable, Dict
 
 from PyQt6 import QtGui, QtCore
-from PyQt6.QtWidgets import QDialog, QAbstractItemView, QMessageBox
-from mvclib import Unspent, Transaction
+from PyQt6.QtWidgets import QDialog, QAbstractItemView, QMessageBox, QLabel, QPushButton
+from mvclib import Transaction, Unspent
 from mvclib.constants import Chain
+from mvclib.keys import PrivateKey
+from mvclib.service.provider import BroadcastResult
 from mvclib.transaction import InsufficientFunds
-from mvclib.utils import validate_address
 from mvclib.wallet import create_transaction
 
-from base import set_table_view, UnspentModel, require_password
+from base import set_table_view, UnspentModel, require_password, show_message
 from designer.send_unspents import Ui_dialogSendUnspents
-from utils import COIN_DECIMAL, format_coin, splitlines_without_blank
+from estimator import FeeEstimator, FeeEstimate
+from loading import ProgressUi
+from metasv import get_provider
+from payout import PayoutPlans, PayoutThread, BATCH_OUTPUTS, batch_amounts
+from receivers import ReceiversParser, ReceiversImporter, ImportedReceivers
+from selection import select_coins
+from sender import SendThread, SendStage
+from store import UnspentStore
+from utils import COIN_DECIMAL, format_coin
 
 
 class SendUnspentsUi(QDialog, Ui_dialogSendUnspents):
-    def __init__(self, password: str, unspents: List[Unspent], chain: Chain, change_address: Optional[str] = None, combine: bool = True):
+    # milliseconds after the last typing to update the fee preview
+    preview_delay = 200
+
+    def __init__(self, password: str, unspents: UnspentStore, chain: Chain, change_address: Optional[str] = None, combine: bool = True,
+                 private_keys: Optional[Callable[[str, int, int], List[PrivateKey]]] = None, payout_plans: Optional[PayoutPlans] = None, wallet: str = ''):
+        """
+        :param combine: spend all the unspents, otherwise the unspents are selected by the amount
+        :param private_keys: returns private keys of (address, change, index) to sign the unspents
+        :param payout_plans: plans of payouts beyond one transaction are persisted to resume, by the wallet key
+        """
         super(SendUnspentsUi, self).__init__()
         self.setupUi(self)
 
         self.password = password
-        self.unspents: List[Unspent] = unspents or []
+        self.unspents: UnspentStore = unspents
+        self.private_keys = private_keys
         self.chain: Chain = chain
         self.change_address = change_address
         self.combine = combine
+        self.payout_plans = payout_plans
+        self.wallet = wallet
         self.receivers: List[Tuple[str, int]] = []
-        self.regex_patter_receivers = f'^\\s*(\\S+)\\s*[,，]\\s*(\\d+(\\.\\d{{1,{COIN_DECIMAL}}})?)\\s*$'
+        self.send_thread: Optional[Union[SendThread, PayoutThread]] = None
+        self.progress: Optional[ProgressUi] = None
+        self.receivers_parser = ReceiversParser(self.chain, COIN_DECIMAL)
+        self.imported: Optional[ImportedReceivers] = None
+        self.receivers_importer = ReceiversImporter(self, self.chain, COIN_DECIMAL)
         self.regex_patter_amount = f'^\\s*\\d+(\\.\\d{{1,{COIN_DECIMAL}}})?\\s*$'
 
-        self.lineEditTotalInput.setText(format_coin(sum([unspent.satoshi for unspent in self.unspents])))
+        self.fee_estimator = FeeEstimator().add_inputs(len(self.unspents), self.unspents.balance())
+        self.lineEditTotalInput.setText(format_coin(self.unspents.balance()))
+        self.labelFee = QLabel()
+        self.formLayout.addRow('Fee', self.labelFee)
+        self.preview_timer = QtCore.QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(SendUnspentsUi.preview_delay)
+        # noinspection PyUnresolvedReferences
+        self.preview_timer.timeout.connect(self.update_preview)
         self.lineEditAmount.setValidator(QtGui.QRegularExpressionValidator(QtCore.QRegularExpression(self.regex_patter_amount), self))
 
         self.unspent_model = UnspentModel(self.unspents)
@@ -43,73 +77,171 @@ class SendUnspentsUi(QDialog, Ui_dialogSendUnspents):
         self.plainTextEditReceivers.textChanged.connect(self.receivers_text_changed)
         self.lineEditAmount.textChanged.connect(self.amount_text_changed)
         self.toolButtonMaxAmount.clicked.connect(self.max_amount_clicked)
+        self.pushButtonImport = QPushButton('Import')
+        self.gridLayout.addWidget(self.pushButtonImport, 1, 0, 1, 1)
+        self.pushButtonImport.clicked.connect(self.import_clicked)
+        self.receivers_importer.imported.connect(self.receivers_imported)
         self.pushButtonSend.clicked.connect(lambda: require_password(self, self.send_transaction, self.password))
 
     # noinspection DuplicatedCode
     def receivers_text_changed(self):
-        lines = splitlines_without_blank(self.plainTextEditReceivers.toPlainText())
+        self.receivers_parser.update(self.plainTextEditReceivers.toPlainText())
+        lines = self.receivers_parser.lines
         receivers_valid = self.receivers_valid()
         self.pushButtonSend.setEnabled(self.amount_valid() and receivers_valid)
-        total_amount = ''
-        if receivers_valid:
-            groups = re.findall(self.regex_patter_receivers, '\n'.join(lines), re.MULTILINE)
-            _total_amount = sum([Decimal(amount) for amount in [group[1] for group in groups]])
-            if _total_amount:
-                total_amount = str(_total_amount)
+        total = (self.imported.total if self.imported else self.receivers_parser.total()) if receivers_valid else 0
+        total_amount = format_coin(total, COIN_DECIMAL, rstrip=True) if total else ''
         self.lineEditAmount.setText(total_amount)
         self.lineEditAmount.setReadOnly(len(lines) > 1 or total_amount != '')
         self.toolButtonMaxAmount.setEnabled(len(lines) == 1 and total_amount == '')
+        self.preview_timer.start()
 
     def amount_text_changed(self):
         self.pushButtonSend.setEnabled(self.amount_valid() and self.receivers_valid())
+        self.preview_timer.start()
+
+    def update_preview(self):
+        """Fee of the transaction to send, estimated by the tally of unspents or by the unspents selected"""
+        if not self.amount_valid() or not self.receivers_valid():
+            self.labelFee.setText('')
+            return
+        self.parse_receivers()
+        amount = sum([satoshi for _, satoshi in self.receivers])
+        # a payout beyond one transaction funds its batches by a split transaction, their fees are paid to the split outputs
+        outputs = batch_amounts(self.receivers) if len(self.receivers) > BATCH_OUTPUTS else [satoshi for _, satoshi in self.receivers]
+        batches_fee = sum(outputs) - amount
+        if self.combine:
+            input_count, estimate = len(self.unspents), self.fee_estimator.estimate(sum(outputs), len(outputs))
+        else:
+            try:
+                selection = select_coins(self.unspents, sum(outputs), len(outputs))
+                input_count, estimate = len(selection.rows), FeeEstimate(selection.size, selection.fee, selection.change, True)
+            except InsufficientFunds:
+                input_count, estimate = len(self.unspents), self.fee_estimator.estimate(sum(outputs), len(outputs))
+        if not estimate.sufficient:
+            self.labelFee.setText(f'Insufficient SPACE, requires {format_coin(amount + batches_fee + estimate.fee)} in total')
+            return
+        text = f'{format_coin(estimate.fee)} SPACE, {estimate.size} bytes of {input_count} inputs'
+        if batches_fee:
+            text = f'{format_coin(estimate.fee + batches_fee)} SPACE, {len(outputs) + 1} transactions of {input_count} inputs'
+        self.labelFee.setText(f'{text}, {format_coin(estimate.change)} SPACE change' if estimate.change else text)
 
     def receivers_valid(self) -> bool:
-        lines = splitlines_without_blank(self.plainTextEditReceivers.toPlainText())
-        if len(lines) == 0:
-            valid = False
+        return self.imported is not None or self.receivers_parser.valid()
+
+    def import_clicked(self):
+        if self.imported:
+            self.receivers_imported(None)
         else:
-            groups = re.findall(self.regex_patter_receivers, '\n'.join(lines), re.MULTILINE)
-            address_all_valid = all([validate_address(address, self.chain) for address in [group[0] for group in groups]])
-            amount_all_valid = all([int(Decimal(amount) * 10 ** COIN_DECIMAL) > 0 for amount in [group[1] for group in groups]])
-            valid = len(groups) == len(lines) and address_all_valid and amount_all_valid
-        if not valid and len(lines) == 1:
-            valid = validate_address(lines[0], self.chain)
-        return valid
+            self.receivers_importer.start()
+
+    def receivers_imported(self, imported: Optional[ImportedReceivers]):
+        """Imported receivers are kept in columns, instead of the text"""
+        self.imported = imported
+        self.pushButtonImport.setText('Clear Import' if imported else 'Import')
+        self.plainTextEditReceivers.setReadOnly(imported is not None)
+        self.plainTextEditReceivers.setPlaceholderText(f'{len(imported.addresses)} receivers imported from {os.path.basename(imported.file)}' if imported else '')
+        self.plainTextEditReceivers.clear()
+        self.receivers_text_changed()
 
     def amount_valid(self) -> bool:
         text = self.lineEditAmount.text()
         return bool(Decimal(text) * 10 ** COIN_DECIMAL) if text else False
 
     def parse_receivers(self):
-        lines = splitlines_without_blank(self.plainTextEditReceivers.toPlainText())
-        self.receivers = []
-        groups = re.findall(self.regex_patter_receivers, '\n'.join(lines), re.MULTILINE)
-        for group in groups:
-            self.receivers.append((group[0], int(Decimal(group[1]) * 10 ** COIN_DECIMAL)))
-        if not self.receivers and len(lines) == 1:
-            self.receivers = [(lines[0], int(Decimal(self.lineEditAmount.text()) * 10 ** COIN_DECIMAL))]
+        if self.imported:
+            self.receivers = list(zip(self.imported.addresses, self.imported.amounts))
+            return
+        self.receivers = self.receivers_parser.receivers()
+        if not self.receivers and len(self.receivers_parser.lines) == 1:
+            self.receivers = [(self.receivers_parser.lines[0], int(Decimal(self.lineEditAmount.text()) * 10 ** COIN_DECIMAL))]
 
     def send_transaction(self):
         self.parse_receivers()
-        try:
-            t = create_transaction(unspents=self.unspents, outputs=self.receivers, leftover=self.change_address, combine=self.combine, chain=self.chain)
-            r = t.broadcast()
-            if r.propagated:
-                QMessageBox.information(self, 'Information', f'Sent successfully.\n\n{r.data}', QMessageBox.StandardButton.Ok)
-            else:
-                QMessageBox.critical(self, 'Critical', f'Failed to send.\n\n{r.data}', QMessageBox.StandardButton.Ok)
-        except InsufficientFunds as e:
-            _groups = re.findall(r'require (\d+) satoshi but only (\d+)', str(e))
-            _message = f'Insufficient SPACE.\n\nRequires {format_coin(_groups[0][0])} in total, but only has {format_coin(_groups[0][1])}.'
-            QMessageBox.critical(self, 'Critical', _message, QMessageBox.StandardButton.Ok)
-        except Exception as e:
-            QMessageBox.critical(self, 'Critical', f'Unknown exception.\n\n{e}', QMessageBox.StandardButton.Ok)
+        self.pushButtonSend.setEnabled(False)
+        if len(self.receivers) > BATCH_OUTPUTS:
+            self.start_send_thread(PayoutThread(self.chain, self.payout_plans, self.wallet, self.receivers, self.change_address, self.select_unspents, parent=self))
+        else:
+            self.start_send_thread(SendThread(self.build_transaction, self))
+
+    def resume_payout(self, plan: Dict):
+        self.pushButtonSend.setEnabled(False)
+        self.start_send_thread(PayoutThread(self.chain, self.payout_plans, self.wallet, plan=plan, parent=self))
+
+    def start_send_thread(self, send_thread: Union[SendThread, PayoutThread]):
+        self.send_thread = send_thread
+        self.send_thread.progress.connect(self.send_progress)
+        self.send_thread.sent.connect(self.transaction_sent)
+        self.progress = ProgressUi(SendStage.Build)
+        self.progress.cancel_clicked.connect(self.cancel_clicked)
+        self.progress.setWindowModality(QtCore.Qt.WindowModality.WindowModal)
+        self.progress.show()
+        self.send_thread.start()
+
+    def select_unspents(self, amount: int, output_count: int) -> List[Unspent]:
+        """Unspents are materialized with their private keys only when selected"""
+        rows = None if self.combine else select_coins(self.unspents, amount, output_count).rows
+        return self.unspents.unspents(rows, self.private_keys)
+
+    def build_transaction(self) -> Transaction:
+        unspents = self.select_unspents(sum([satoshi for _, satoshi in self.receivers]), len(self.receivers))
+        return create_transaction(unspents=unspents, outputs=self.receivers, leftover=self.change_address, combine=True, sign=False, provider=get_provider(self.chain))
+
+    def send_progress(self, stage: str, done: int, total: int):
+        self.progress.update_progress(f'{stage} {done}/{total} ...' if total else f'{stage} ...', done, total)
+        self.progress.set_cancellable(self.send_thread.cancellable() and not self.send_thread.isInterruptionRequested())
+
+    def cancel_clicked(self):
+        if self.send_thread.cancel():
+            self.progress.set_cancellable(False)
+
+    def transaction_sent(self, r: Union[BroadcastResult, Exception, None]):
+        self.progress.accept()
+        if r is None:
+            self.pushButtonSend.setEnabled(self.amount_valid() and self.receivers_valid())
+            return
+        if isinstance(r, BroadcastResult) and r.propagated:
+            icon, title, message = QMessageBox.Icon.Information, 'Information', f'Sent successfully.\n\n{r.data}'
+        elif isinstance(r, BroadcastResult):
+            icon, title, message = QMessageBox.Icon.Critical, 'Critical', f'Failed to send.\n\n{r.data}'
+        elif isinstance(r, InsufficientFunds):
+            _groups = re.findall(r'require (\d+) satoshi but only (\d+)', str(r))
+            icon, title, message = QMessageBox.Icon.Critical, 'Critical', f'Insufficient SPACE.\n\nRequires {format_coin(_groups[0][0])} in total, but only has {format_coin(_groups[0][1])}.'
+        else:
+            icon, title, message = QMessageBox.Icon.Critical, 'Critical', f'Unknown exception.\n\n{r}'
         # force to refresh wallet no matter what the result is
-        self.accept()
+        show_message(self, icon, title, message, self.accept)
+
+    def exec(self) -> int:
+        """Offer to resume the payout of the wallet which was interrupted, before sending anything else"""
+        plan = self.payout_plans.plan(self.wallet) if self.payout_plans else None
+        if plan:
+            text = (f'A payout to {plan["receivers"]} receivers was interrupted, {plan["broadcast"]} of {len(plan["transactions"])} transactions were broadcast.\n\n'
+                    'Resume it? Otherwise it is discarded, and the transactions not broadcast are never sent.')
+            buttons = QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No | QMessageBox.StandardButton.Cancel
+            answer = QMessageBox.question(self, 'Payout', text, buttons, QMessageBox.StandardButton.Yes)
+            if answer == QMessageBox.StandardButton.Cancel:
+                return 0
+            if answer == QMessageBox.StandardButton.Yes:
+                QtCore.QTimer.singleShot(0, lambda: require_password(self, self.resume_payout, self.password, plan=plan))
+            else:
+                try:
+                    self.payout_plans.remove(self.wallet)
+                except OSError as e:
+                    QMessageBox.critical(self, 'Critical', f'The interrupted payout cannot be discarded.\n\n{e}', QMessageBox.StandardButton.Ok)
+                    return 0
+        return super().exec()
+
+    def closeEvent(self, a0: QtGui.QCloseEvent) -> None:
+        # the transaction might be broadcast already, wait for the result
+        if self.send_thread and self.send_thread.isRunning():
+            a0.ignore()
+        else:
+            super().closeEvent(a0)
 
     def max_amount_clicked(self):
-        t = Transaction(chain=self.chain).add_inputs(self.unspents).add_change()
-        self.lineEditAmount.setText(format_coin(t.tx_outputs[0].satoshi))
+        """All the unspents to one output"""
+        self.lineEditAmount.setText(format_coin(self.fee_estimator.max_amount(1)))
 
     def keyPressEvent(self, a0: QtGui.QKeyEvent) -> None:
         if a0.key() in [QtCore.Qt.Key.Key_Enter, QtCore.Qt.Key.Key_Return, QtCore.Qt.Key.Key_Escape]:
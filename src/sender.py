@@ -0,0 +1,140 @@
+import os
+import threading
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Dict, Iterator, Tuple
+
+from PyQt6 import QtCore
+from mvclib import Transaction
+from mvclib.transaction import TxInput
+from mvclib.keys import PrivateKey
+
+from derivation import executor
+
+
+class SendStage:
+    Build = 'Building'
+    Sign = 'Signing'
+    Broadcast = 'Broadcasting'
+
+
+# inputs signed by a worker process at a time, and reported as one step of progress
+SIGN_CHUNK_SIZE = 250
+
+
+def _sign_chunk(secrets: List[List[bytes]], digests: List[bytes]) -> List[List[bytes]]:
+    """Signatures of every input in the chunk, by the secrets of its private keys"""
+    keys: Dict[bytes, PrivateKey] = {}
+    return [[keys.setdefault(secret, PrivateKey(secret)).sign(digest) for secret in input_secrets] for input_secrets, digest in zip(secrets, digests)]
+
+
+def sign_digests_chunked(tx_inputs: List[TxInput], digests: List[bytes], chunk_size: int = SIGN_CHUNK_SIZE, parallel: Optional[bool] = None) -> Iterator[List[List[bytes]]]:
+    """
+    Sign the digests of inputs chunk by chunk, chunks are yielded in order as soon as they are signed.
+    Chunks are signed on the process pool when parallel, which is by default when there is more than one chunk and more than one CPU.
+    Closing the iterator early cancels the chunks not started yet.
+    """
+    chunks = [range(i, min(i + chunk_size, len(tx_inputs))) for i in range(0, len(tx_inputs), chunk_size)]
+    if parallel is None:
+        parallel = len(chunks) > 1 and (os.cpu_count() or 1) > 1
+    if not parallel:
+        for chunk in chunks:
+            yield [[private_key.sign(digests[i]) for private_key in tx_inputs[i].private_keys] for i in chunk]
+        return
+    futures: List[Future] = [
+        executor().submit(_sign_chunk, [[private_key.key.secret for private_key in tx_inputs[i].private_keys] for i in chunk], [digests[i] for i in chunk])
+        for chunk in chunks
+    ]
+    try:
+        for future in futures:
+            yield future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def sign_transactions(ts: List[Transaction], progress: Optional[Callable[[int, int], None]] = None, cancelled: Optional[Callable[[], bool]] = None,
+                      parallel: Optional[bool] = None) -> bool:
+    """
+    Same as Transaction.sign of every transaction, but chunk by chunk so that the progress is reported and the signing can stop in the middle.
+    Digests are cheap and computed here, signing them is spread over the process pool, across the transactions.
+    :returns: False if cancelled
+    """
+    pending: List[Tuple[Transaction, TxInput]] = []
+    digests: List[bytes] = []
+    for t in ts:
+        for tx_input, digest in zip(t.tx_inputs, t.digests()):
+            if tx_input.unlocking_script is None:
+                pending.append((t, tx_input))
+                digests.append(digest)
+    chunks = sign_digests_chunked([tx_input for _, tx_input in pending], digests, parallel=parallel)
+    done = 0
+    try:
+        for signatures in chunks:
+            if cancelled and cancelled():
+                return False
+            for (t, tx_input), input_signatures in zip(pending[done:done + len(signatures)], signatures):
+                payload = {'signatures': input_signatures, 'private_keys': tx_input.private_keys, 'sighash': tx_input.sighash}
+                tx_input.unlocking_script = tx_input.script_type.unlocking(**payload, **t.kwargs)
+            done += len(signatures)
+            if progress:
+                progress(done, len(pending))
+    finally:
+        chunks.close()
+    return True
+
+
+def sign_transaction(t: Transaction, progress: Optional[Callable[[int, int], None]] = None, cancelled: Optional[Callable[[], bool]] = None,
+                     parallel: Optional[bool] = None) -> bool:
+    return sign_transactions([t], progress, cancelled, parallel)
+
+
+class SendThread(QtCore.QThread):
+    """
+    Build, sign and broadcast a transaction off the GUI thread.
+    Cancelling stops the pipeline before the broadcast, a transaction being broadcast is not cancellable anymore.
+    """
+    # stage, done, total (0 when unknown)
+    progress = QtCore.pyqtSignal(str, int, int)
+    # BroadcastResult, None if cancelled, or the exception raised by any stage
+    sent = QtCore.pyqtSignal(object)
+
+    def __init__(self, build: Callable[[], Transaction], parent: Optional[QtCore.QObject] = None):
+        """:param build: returns the unsigned transaction"""
+        super(SendThread, self).__init__(parent)
+        self.build = build
+        self.transaction: Optional[Transaction] = None
+        # the broadcast starts and the cancel is accepted exclusively
+        self.cancel_lock = threading.Lock()
+
+    def run(self):
+        try:
+            self.progress.emit(SendStage.Build, 0, 0)
+            t = self.build()
+            if self.isInterruptionRequested():
+                self.sent.emit(None)
+                return
+            self.progress.emit(SendStage.Sign, 0, len(t.tx_inputs))
+            if not sign_transaction(t, lambda done, total: self.progress.emit(SendStage.Sign, done, total), self.isInterruptionRequested):
+                self.sent.emit(None)
+                return
+            with self.cancel_lock:
+                self.transaction = t
+                cancelled = self.isInterruptionRequested()
+            if cancelled:
+                self.sent.emit(None)
+                return
+            self.progress.emit(SendStage.Broadcast, 0, 0)
+            self.sent.emit(t.broadcast())
+        except Exception as e:
+            self.sent.emit(e)
+
+    def cancellable(self) -> bool:
+        return self.transaction is None
+
+    def cancel(self) -> bool:
+        """:returns: False if the broadcast started already"""
+        with self.cancel_lock:
+            if not self.cancellable():
+                return False
+            self.requestInterruption()
+            return True
@@ -141,8 +141,15 @@ class StartupUi(QWidget, Ui_formStartup):
 
 if __name__ == '__main__':
     import sys
+    from multiprocessing import freeze_support
     from PyQt6.QtWidgets import QApplication
 
+    from contract import register_scheme
+
+    # key derivation runs on a process pool, which needs this in a frozen app
+    freeze_support()
+    register_scheme()
+
     app = QApplication(sys.argv)
     w = StartupUi()
     w.show()
@@ -0,0 +1,111 @@
+from typing import List, Dict, Optional, Tuple, Callable, Iterator
+
+import numpy as np
+from mvclib import Unspent
+from mvclib.keys import PrivateKey
+
+
+class UnspentStore:
+    """
+    Unspents of a wallet in columns, one array per field and addresses interned to ids.
+    Outpoints are packed as 36 bytes (txid bytes and big-endian vout) to match and sort unspents by outpoint.
+    Path is "./change/index" of the key locking the unspent in an HD wallet, -1 when it is unknown.
+    Unspent objects are materialized only to build transactions.
+    """
+
+    def __init__(self, outpoints: np.ndarray, vouts: np.ndarray, satoshis: np.ndarray, heights: np.ndarray, address_ids: np.ndarray, addresses: List[str],
+                 changes: np.ndarray, indexes: np.ndarray):
+        self.outpoints = outpoints
+        self.vouts = vouts
+        self.satoshis = satoshis
+        self.heights = heights
+        self.address_ids = address_ids
+        self.addresses = addresses
+        self.changes = changes
+        self.indexes = indexes
+        self._value_order: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_dicts(cls, unspents: List[Dict]) -> 'UnspentStore':
+        """Build from the unspent dicts of the chain API, fields are named as the arguments of Unspent"""
+        address_ids: Dict[str, int] = {}
+        for unspent in unspents:
+            address_ids.setdefault(unspent['address'], len(address_ids))
+        vouts = np.fromiter((int(unspent['vout']) for unspent in unspents), dtype=np.uint32, count=len(unspents))
+        return cls(
+            outpoints=UnspentStore.pack_outpoints(unspents, vouts),
+            vouts=vouts,
+            satoshis=np.fromiter((int(unspent['satoshi']) for unspent in unspents), dtype=np.int64, count=len(unspents)),
+            heights=np.fromiter((-1 if unspent.get('height') is None else unspent['height'] for unspent in unspents), dtype=np.int64, count=len(unspents)),
+            address_ids=np.fromiter((address_ids[unspent['address']] for unspent in unspents), dtype=np.int32, count=len(unspents)),
+            addresses=list(address_ids.keys()),
+            changes=np.fromiter((unspent.get('addressType', -1) for unspent in unspents), dtype=np.int32, count=len(unspents)),
+            indexes=np.fromiter((unspent.get('addressIndex', -1) for unspent in unspents), dtype=np.int32, count=len(unspents)),
+        )
+
+    @classmethod
+    def from_unspents(cls, unspents: List[Unspent]) -> 'UnspentStore':
+        return cls.from_dicts([{'txid': u.txid, 'vout': u.vout, 'satoshi': u.satoshi, 'height': u.height, 'address': u.address} for u in unspents])
+
+    @classmethod
+    def empty(cls) -> 'UnspentStore':
+        return cls.from_dicts([])
+
+    @classmethod
+    def pack_outpoints(cls, unspents: List[Dict], vouts: np.ndarray) -> np.ndarray:
+        buffer = b''.join(bytes.fromhex(unspent['txid']) for unspent in unspents)
+        packed = np.zeros((len(unspents), 36), dtype=np.uint8)
+        packed[:, :32] = np.frombuffer(buffer, dtype=np.uint8).reshape(-1, 32)
+        packed[:, 32:] = vouts.astype('>u4').view(np.uint8).reshape(-1, 4)
+        # fixed width bytes compare and sort the same as the raw bytes, trailing zeros are only stripped when read back
+        return packed.view('S36').reshape(-1)
+
+    def __len__(self) -> int:
+        return len(self.satoshis)
+
+    def txid(self, row: int) -> str:
+        return bytes(self.outpoints[row]).ljust(36, b'\x00')[:32].hex()
+
+    def value_order(self) -> np.ndarray:
+        """Rows in ascending order of satoshi, sorted once"""
+        if self._value_order is None:
+            self._value_order = np.argsort(self.satoshis, kind='stable')
+        return self._value_order
+
+    def address(self, row: int) -> str:
+        return self.addresses[self.address_ids[row]]
+
+    def balance(self) -> int:
+        return int(self.satoshis.sum())
+
+    def records(self) -> Iterator[Tuple[str, int, int, int, str]]:
+        """(txid, vout, satoshi, height, address) of every unspent"""
+        for row in range(len(self)):
+            yield self.txid(row), int(self.vouts[row]), int(self.satoshis[row]), int(self.heights[row]), self.address(row)
+
+    def address_summary(self) -> Dict[str, Tuple[int, int]]:
+        """Address -> (number of unspents, balance)"""
+        counts = np.bincount(self.address_ids, minlength=len(self.addresses))
+        balances = np.zeros(len(self.addresses), dtype=np.int64)
+        np.add.at(balances, self.address_ids, self.satoshis)
+        return {address: (int(counts[i]), int(balances[i])) for i, address in enumerate(self.addresses) if counts[i]}
+
+    def rows_of(self, addresses: List[str]) -> np.ndarray:
+        addresses = set(addresses)
+        ids = [i for i, address in enumerate(self.addresses) if address in addresses]
+        return np.flatnonzero(np.isin(self.address_ids, ids))
+
+    def select(self, rows: np.ndarray) -> 'UnspentStore':
+        return UnspentStore(self.outpoints[rows], self.vouts[rows], self.satoshis[rows], self.heights[rows], self.address_ids[rows], self.addresses, self.changes[rows], self.indexes[rows])
+
+    def unspents(self, rows: Optional[np.ndarray] = None, private_keys: Optional[Callable[[str, int, int], List[PrivateKey]]] = None) -> List[Unspent]:
+        """
+        Materialize unspents to build a transaction
+        :param private_keys: returns private keys of (address, change, index)
+        """
+        unspents: List[Unspent] = []
+        for row in range(len(self)) if rows is None else rows:
+            address = self.address(row)
+            keys = private_keys(address, int(self.changes[row]), int(self.indexes[row])) if private_keys else []
+            unspents.append(Unspent(txid=self.txid(row), vout=int(self.vouts[row]), satoshi=int(self.satoshis[row]), height=int(self.heights[row]), address=address, private_keys=keys))
+        return unspents
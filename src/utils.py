@@ -1,7 +1,8 @@
 import json
 from contextlib import suppress
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Any, Sequence, Union
 
+import numpy as np
 from mvclib import PublicKey
 from mvclib.aes import aes_encrypt_with_iv, aes_decrypt_with_iv
 from mvclib.constants import Chain
@@ -12,18 +13,25 @@ from mvclib.utils import decode_wif, decode_address
 COIN_DECIMAL = 8
 
 
-def encrypt_account(account: List[Dict], password: str) -> bytes:
+def encrypt_json(o: Any, password: str) -> bytes:
     k: bytes = sha256(password.encode('utf-8'))
     key, iv = k[:16], k[16:]
-    message: bytes = json.dumps(account).encode('utf-8')
+    message: bytes = json.dumps(o).encode('utf-8')
     return aes_encrypt_with_iv(key, iv, message)
 
 
-def decrypt_account(message: bytes, password: str) -> List[Dict]:
+def decrypt_json(message: bytes, password: str) -> Any:
     k: bytes = sha256(password.encode('utf-8'))
     key, iv = k[:16], k[16:]
-    account: str = aes_decrypt_with_iv(key, iv, message).decode('utf-8')
-    return json.loads(account)
+    return json.loads(aes_decrypt_with_iv(key, iv, message).decode('utf-8'))
+
+
+def encrypt_account(account: List[Dict], password: str) -> bytes:
+    return encrypt_json(account, password)
+
+
+def decrypt_account(message: bytes, password: str) -> List[Dict]:
+    return decrypt_json(message, password)
 
 
 def write_account_file(account: List[Dict], file: str, password: str):
@@ -37,8 +45,15 @@ def read_account_file(file: str, password: str) -> List[Dict]:
 
 
 def format_coin(amount: int, decimal: int = 8, decimal_digits: int = None, fixed_length: int = 0, rstrip: bool = False) -> str:
+    """Amount in the smallest unit formatted in integers, exact for any decimal, rounded half up when showing fewer digits"""
     decimal_digits = decimal_digits or decimal
-    s = format(float(amount) / 10 ** decimal, f'.{decimal_digits}f')
+    amount = int(amount)
+    if decimal_digits < decimal:
+        scale = 10 ** (decimal - decimal_digits)
+        amount = (abs(amount) + scale // 2) // scale * (-1 if amount < 0 else 1)
+    else:
+        amount *= 10 ** (decimal_digits - decimal)
+    s = _format_fixed(amount, decimal_digits)
     if fixed_length:
         s = s[0:fixed_length]
     if rstrip and '.' in s:
@@ -46,6 +61,23 @@ def format_coin(amount: int, decimal: int = 8, decimal_digits: int = None, fixed
     return s
 
 
+def _format_fixed(amount: int, digits: int) -> str:
+    whole, fraction = divmod(abs(amount), 10 ** digits)
+    sign = '-' if amount < 0 else ''
+    return f'{sign}{whole}.{fraction:0{digits}d}' if digits else f'{sign}{whole}'
+
+
+def format_coins(amounts: Union[Sequence[int], np.ndarray], decimal: int = COIN_DECIMAL) -> List[str]:
+    """Format a column of amounts at once, same as format_coin of every amount"""
+    if not isinstance(amounts, np.ndarray) or amounts.dtype.kind not in 'iu' or decimal > 18:
+        return [_format_fixed(int(amount), decimal) for amount in amounts]
+    wholes, fractions = np.divmod(np.abs(amounts), 10 ** decimal)
+    signs = np.where(amounts < 0, '-', '').tolist()
+    if not decimal:
+        return [f'{sign}{whole}' for sign, whole in zip(signs, wholes.tolist())]
+    return [f'{sign}{whole}.{fraction:0{decimal}d}' for sign, whole, fraction in zip(signs, wholes.tolist(), fractions.tolist())]
+
+
 def xprv_valid(xprv: str, chain: Optional[Chain] = None) -> bool:
     with suppress(Exception):
         _xprv = Xprv(xprv)
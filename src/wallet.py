@@ -1,31 +1,36 @@
 import random
 from typing import List, Dict, Optional, Union
 
+import numpy as np
 from PyQt6 import QtCore, QtGui
 from PyQt6.QtWidgets import QWidget
 from mvclib import Unspent, Key
 from mvclib.constants import Chain
-from mvclib.hd import Xprv, derive_xkeys_from_xkey, Xpub
-from mvclib.service import MvcApi
+from mvclib.hd import Xprv, Xpub
+from mvclib.keys import PrivateKey
 from mvclib.utils import decode_address
 
 from base import copy_to_clipboard, set_table_view, UnspentModel, FtModel, copy_table_selected, table_select_all
+from cache import UnspentCache, KeyCache, wallet_key
 from designer.wallet import Ui_formWallet
+from discovery import discover_used_index, GAP_LIMIT
 from keys import KeysUi
-from metasv import ft_balance, TIMEOUT
+from metasv import ft_balance, get_provider
+from payout import PayoutPlans
 from send_ft import SendFtUi
+from scheduler import RefreshScheduler
 from send_unspents import SendUnspentsUi
+from store import UnspentStore
 from utils import format_coin
 
 
-class RefreshUnspentThread(QtCore.QThread):
-    refreshed = QtCore.pyqtSignal(object)
+class RefreshUnspentJob:
 
     def __init__(self, key: Union[Xprv, Xpub, Key, str], client_key: str):
-        super(RefreshUnspentThread, self).__init__()
         self.kwargs = {'throw': True}
         if type(key) is Xprv:
-            self.kwargs.update({'xprv': key})
+            # private keys are derived from the key path of the unspent only when a transaction is built
+            self.kwargs.update({'xpub': key.xpub()})
             self.chain = key.chain
             self.xkey = True
         elif type(key) is Xpub:
@@ -33,7 +38,7 @@ class RefreshUnspentThread(QtCore.QThread):
             self.chain = key.chain
             self.xkey = True
         elif type(key) is Key:
-            self.kwargs.update({'private_keys': [key]})
+            self.kwargs.update({'address': key.address()})
             self.chain = key.chain
             self.xkey = False
         else:
@@ -44,22 +49,16 @@ class RefreshUnspentThread(QtCore.QThread):
         self.update_fields(client_key)
 
     def update_fields(self, client_key: str):
-        self.provider = MvcApi(chain=self.chain, timeout=TIMEOUT, client_key=client_key)
+        self.provider = get_provider(self.chain, client_key)
 
-    def run(self):
-        try:
-            unspents = self.provider.get_xpub_unspents(**self.kwargs) if self.xkey else self.provider.get_unspents(**self.kwargs)
-            self.refreshed.emit([Unspent(**unspent) for unspent in unspents])
-        except Exception as e:
-            print(f'refresh unspent thread exception: {e}')
-            self.refreshed.emit(None)
+    def __call__(self) -> UnspentStore:
+        unspents = self.provider.get_xpub_unspents(**self.kwargs) if self.xkey else self.provider.get_unspents(**self.kwargs)
+        return UnspentStore.from_dicts(unspents)
 
 
-class RefreshFtThread(QtCore.QThread):
-    refreshed = QtCore.pyqtSignal(object)
+class RefreshFtJob:
 
     def __init__(self, address: str, client_key: str):
-        super(RefreshFtThread, self).__init__()
         self.address = address
         self.client_key = None
         self.update_fields(client_key)
@@ -67,48 +66,72 @@ class RefreshFtThread(QtCore.QThread):
     def update_fields(self, client_key: str):
         self.client_key = client_key or '-'
 
-    def run(self):
-        try:
-            self.refreshed.emit(ft_balance(self.address, self.client_key, throw=True))
-        except Exception as e:
-            print(f'refresh ft thread exception: {e}')
-            self.refreshed.emit(None)
+    def __call__(self) -> List[Dict]:
+        return ft_balance(self.address, self.client_key, throw=True)
+
+
+class DiscoverJob:
+
+    def __init__(self, xkey: Union[Xprv, Xpub], client_key: str):
+        self.xkey = xkey
+        self.provider = None
+        self.update_fields(client_key)
+
+    def update_fields(self, client_key: str):
+        self.provider = get_provider(self.xkey.chain, client_key)
+
+    def __call__(self) -> Dict:
+        receive_used = discover_used_index(self.xkey, 0, self.provider.address_used)
+        change_used = discover_used_index(self.xkey, 1, self.provider.address_used)
+        return {'receive_used': receive_used, 'change_used': change_used}
 
 
 class WalletUi(QWidget, Ui_formWallet):
     wallet_updated = QtCore.pyqtSignal(object, int)
     network_status_updated = QtCore.pyqtSignal(bool)
 
-    def __init__(self, app_settings: Dict, password: str, w: Dict, account_index: int):
+    def __init__(self, app_settings: Dict, password: str, w: Dict, account_index: int, unspent_cache: UnspentCache, key_cache: KeyCache, payout_plans: PayoutPlans,
+                 scheduler: RefreshScheduler):
         super(WalletUi, self).__init__()
         self.setupUi(self)
 
         self.app_settings = app_settings
+        self.unspent_cache = unspent_cache
+        self.key_cache = key_cache
+        self.payout_plans = payout_plans
+        self.scheduler = scheduler
         self.password = password
         self.w: Dict = w
         self.account_index: int = account_index
 
         self.xkey: Union[Xprv, Xpub, None] = None
+        # public keys of HD wallet are derived from xpub, and read from the key cache
+        self.xpub: Optional[Xpub] = None
         self.key: Optional[Key] = None
         self.address: str = ''
         if w.get('xprv'):
             self.xkey = Xprv(w['xprv'])
-            self.key = derive_xkeys_from_xkey(self.xkey, 0, 1, 0)[0].private_key()
-            self.address = self.key.address()
+            self.xpub = Xpub(w['xpub']) if w.get('xpub') else self.xkey.xpub()
         elif w.get('xpub'):
             self.xkey = Xpub(w['xpub'])
-            self.address = derive_xkeys_from_xkey(self.xkey, 0, 1, 0)[0].address()
+            self.xpub = self.xkey
         elif w.get('wif'):
             self.key = Key(w['wif'])
             self.address = self.key.address()
         else:
             self.address = w['address']
+        if self.xpub:
+            self.address = self.key_cache.key(self.xpub, 0, 0).address
         _, self.chain = decode_address(self.address)
+        self.watch_only = self.key is None and type(self.xkey) is not Xprv
+        self.wallet_key = wallet_key(str(self.xpub or self.address))
+        # unspents from the cache have no private keys, and they might be spent already
+        self.unspents_refreshed = False
 
         if self.xkey:
-            self.keys_widget = KeysUi(self.password, self.w)
+            self.keys_widget = KeysUi(self.password, self.w, self.key_cache, self.payout_plans)
             self.keys_widget.request_refresh.connect(self.refresh_button_clicked)
-            unspent_address = derive_xkeys_from_xkey(self.xkey, self.w['receive_index'], self.w['receive_index'] + 1, 0)[0].address()
+            unspent_address = self.key_cache.key(self.xpub, 0, self.w['receive_index']).address
         else:
             self.keys_widget = None
             unspent_address = self.address
@@ -118,18 +141,18 @@ class WalletUi(QWidget, Ui_formWallet):
         self.labelUnspentAddress.setTextInteractionFlags(QtCore.Qt.TextInteractionFlag.TextSelectableByMouse)
         self.labelFtAddress.setTextInteractionFlags(QtCore.Qt.TextInteractionFlag.TextSelectableByMouse)
 
-        watch_only_hint = ' (Watching-Only) ' if self.key is None else ''
+        watch_only_hint = ' (Watching-Only) ' if self.watch_only else ''
         chain_hint = ' (Testnet) ' if self.chain == Chain.TEST else ' (Mainnet) '
         self.labelHint.setText(chain_hint + watch_only_hint)
         self.labelUnspentAddress.setText(unspent_address)
         self.labelFtAddress.setText(self.address)
         self.toolBox.setCurrentIndex(0)
 
-        self.refresh_unspent_thread = RefreshUnspentThread(self.xkey or self.key or self.address, self.app_settings['client_key'])
-        self.refresh_unspent_thread.refreshed.connect(self.refresh_unspent_table_and_balance)
+        self.refresh_unspent_job = RefreshUnspentJob(self.xkey or self.key or self.address, self.app_settings['client_key'])
         self.unspent_model = UnspentModel()
         self.tableViewUnspent.setModel(self.unspent_model)
         set_table_view(self.tableViewUnspent)
+        self.tableViewUnspent.sortByColumn(0, QtCore.Qt.SortOrder.AscendingOrder)
         self.toolButtonUnspentAddressCopy.clicked.connect(lambda: copy_to_clipboard(self.labelUnspentAddress.text()))
         self.toolButtonUnspentAddressChange.clicked.connect(self.unspent_address_change_button_clicked)
         self.toolButtonUnspentKeys.clicked.connect(self.keys_button_clicked)
@@ -139,11 +162,14 @@ class WalletUi(QWidget, Ui_formWallet):
         self.pushButtonUnspentCopy.clicked.connect(lambda: copy_table_selected(self.tableViewUnspent))
         self.pushButtonUnspentSelectAll.clicked.connect(lambda: table_select_all(self.tableViewUnspent))
 
-        self.refresh_ft_thread = RefreshFtThread(self.address, self.app_settings['client_key'])
-        self.refresh_ft_thread.refreshed.connect(self.refresh_ft_table)
+        self.refresh_ft_job = RefreshFtJob(self.address, self.app_settings['client_key'])
+        # discover the used addresses of HD wallet once a time the widget is built
+        self.discover_job = DiscoverJob(self.xkey, self.app_settings['client_key']) if self.xkey else None
+        self.discovered = False
         self.ft_model = FtModel()
         self.tableViewFt.setModel(self.ft_model)
         set_table_view(self.tableViewFt)
+        self.tableViewFt.sortByColumn(0, QtCore.Qt.SortOrder.AscendingOrder)
         self.toolButtonFtAddressCopy.clicked.connect(lambda: copy_to_clipboard(self.labelFtAddress.text()))
         self.pushButtonFtSend.setEnabled(False)
         self.pushButtonFtSend.clicked.connect(self.ft_send_button_clicked)
@@ -156,10 +182,10 @@ class WalletUi(QWidget, Ui_formWallet):
         # noinspection PyUnresolvedReferences
         self.refresh_button_enable_timer.timeout.connect(lambda: self.pushButtonRefresh.setEnabled(True))
 
+        self.show_unspents(self.unspent_cache.load(self.wallet_key, self.chain))
         self.pushButtonRefresh.clicked.connect(self.refresh_button_clicked)
-        self.refresh_button_clicked()
 
-        if self.key is None:
+        if self.watch_only:
             self.pushButtonUnspentSend.setVisible(False)
             self.pushButtonFtSend.setVisible(False)
         if self.xkey is None:
@@ -168,7 +194,7 @@ class WalletUi(QWidget, Ui_formWallet):
 
     def unspent_address_change_button_clicked(self):
         self.w['receive_index'] = (self.w['receive_index'] + 1) % self.w['receive_limit']
-        unspent_address = derive_xkeys_from_xkey(self.xkey, self.w['receive_index'], self.w['receive_index'] + 1, 0)[0].address()
+        unspent_address = self.key_cache.key(self.xpub, 0, self.w['receive_index']).address
         self.labelUnspentAddress.setText(unspent_address)
         self.wallet_updated.emit(self.w, self.account_index)
 
@@ -179,49 +205,82 @@ class WalletUi(QWidget, Ui_formWallet):
             self.keys_widget.show()
 
     def refresh_button_clicked(self):
+        self.refresh(RefreshScheduler.Visible)
+
+    def refresh(self, priority: int = RefreshScheduler.Background):
         self.pushButtonRefresh.setEnabled(False)
         self.refresh_button_enable_timer.start(10 * 1000)
-        if not self.refresh_unspent_thread.isRunning():
-            self.refresh_unspent_thread.start()
-        if not self.refresh_ft_thread.isRunning():
-            self.refresh_ft_thread.start()
+        self.scheduler.submit(f'{self.account_index}/unspent', self.refresh_unspent_job, self.refresh_unspent_table_and_balance, priority)
+        self.scheduler.submit(f'{self.account_index}/ft', self.refresh_ft_job, self.refresh_ft_table, priority)
+        if self.discover_job and not self.discovered:
+            self.scheduler.submit(f'{self.account_index}/discover', self.discover_job, self.discover_addresses, RefreshScheduler.Background)
+
+    def promote_refresh(self):
+        self.scheduler.promote(f'{self.account_index}/unspent')
+        self.scheduler.promote(f'{self.account_index}/ft')
 
     def closeEvent(self, a0: QtGui.QCloseEvent) -> None:
+        self.scheduler.cancel(f'{self.account_index}/unspent')
+        self.scheduler.cancel(f'{self.account_index}/ft')
+        self.scheduler.cancel(f'{self.account_index}/discover')
         if self.keys_widget:
+            self.keys_widget.stop_derivation()
             self.keys_widget.close()
         super().closeEvent(a0)
 
-    def refresh_unspent_table_and_balance(self, unspents: Optional[List[Unspent]]):
+    def refresh_unspent_table_and_balance(self, unspents: Optional[UnspentStore]):
         if unspents is not None:
-            self.unspent_model.update_fields(unspents)
-            self.tableViewUnspent.sortByColumn(0, QtCore.Qt.SortOrder.AscendingOrder)
-            self.tableViewUnspent.clearSelection()
-            self.labelUnspentBalance.setText(format_coin(sum([unspent.satoshi for unspent in unspents])))
-            self.toolBox.setItemText(self.toolBox.indexOf(self.pageUnspent), f'UTXO（{len(unspents)}）' if unspents else 'UTXO')
-            self.pushButtonUnspentSend.setEnabled(len(unspents) > 0)
+            self.unspent_cache.merge(self.wallet_key, self.chain, unspents)
+            self.unspents_refreshed = True
+            self.show_unspents(unspents)
         self.network_status_updated.emit(unspents is not None)
+
+    def show_unspents(self, unspents: UnspentStore):
+        self.unspent_model.update_fields(unspents)
+        self.labelUnspentBalance.setText(format_coin(unspents.balance()))
+        self.toolBox.setItemText(self.toolBox.indexOf(self.pageUnspent), f'UTXO（{len(unspents)}）' if len(unspents) else 'UTXO')
+        self.pushButtonUnspentSend.setEnabled(self.unspents_refreshed and len(unspents) > 0)
         if self.keys_widget:
-            self.keys_widget.update_fields(unspents=unspents)
+            self.keys_widget.update_fields(unspents=unspents, unspents_refreshed=self.unspents_refreshed)
 
     def unspent_send_button_clicked(self):
         unspents_selected = self.unspents_selected()
-        combine = True if len(unspents_selected) > 0 else False
-        unspents = unspents_selected or self.unspent_model.unspents
+        combine = unspents_selected is not None
+        unspents = unspents_selected if combine else self.unspent_model.store
         if self.xkey:
-            change_index = random.randrange(0, self.w['change_limit'])
-            change_address = derive_xkeys_from_xkey(self.xkey, change_index, change_index + 1, 1)[0].address()
+            change_index = random.randrange(self.w.get('change_used', -1) + 1, self.w['change_limit'])
+            change_address = self.key_cache.key(self.xpub, 1, change_index).address
         else:
             change_address = self.address
-        dialog = SendUnspentsUi(self.password, unspents, self.chain, change_address, combine)
+        dialog = SendUnspentsUi(self.password, unspents, self.chain, change_address, combine, self.private_keys, self.payout_plans, self.wallet_key)
         if dialog.exec():
             self.tableViewUnspent.clearSelection()
             self.refresh_button_clicked()
 
-    def unspents_selected(self) -> List[Unspent]:
-        unspents: List[Unspent] = []
-        for row in set(index.row() for index in self.tableViewUnspent.selectedIndexes()):
-            unspents.append(self.unspent_model.unspents[row])
-        return unspents
+    def discover_addresses(self, used: Optional[Dict]):
+        """Keep GAP_LIMIT unused addresses after the last used one at least, limits are never shrunk"""
+        if used is None:
+            return
+        self.discovered = True
+        self.w.update(used)
+        self.w['receive_limit'] = max(self.w['receive_limit'], max(used['receive_used'], self.w['receive_index']) + 1 + GAP_LIMIT)
+        self.w['change_limit'] = max(self.w['change_limit'], used['change_used'] + 1 + GAP_LIMIT)
+        self.wallet_updated.emit(self.w, self.account_index)
+        if self.keys_widget:
+            self.keys_widget.update_fields(w=self.w)
+
+    def unspents_selected(self) -> Optional[UnspentStore]:
+        rows = set(index.row() for index in self.tableViewUnspent.selectedIndexes())
+        return self.unspent_model.store.select(self.unspent_model.source_rows(rows)) if rows else None
+
+    def unspents(self, rows: Optional[np.ndarray] = None) -> List[Unspent]:
+        """Materialize the unspents with their private keys to build a transaction"""
+        return self.unspent_model.store.unspents(rows, self.private_keys)
+
+    def private_keys(self, address: str, change: int, index: int) -> List[PrivateKey]:
+        if type(self.xkey) is Xprv and change >= 0:
+            return [self.xkey.ckd(change).ckd(index).private_key()]
+        return [self.key] if self.key else []
 
     def enable_ft_send_button(self):
         self.pushButtonFtSend.setEnabled(len(self.fts_selected()) == 1)
@@ -229,28 +288,32 @@ class WalletUi(QWidget, Ui_formWallet):
     def refresh_ft_table(self, fts: Optional[List[Dict]]):
         if fts is not None:
             self.ft_model.update_fields(fts)
-            self.tableViewFt.sortByColumn(0, QtCore.Qt.SortOrder.AscendingOrder)
-            self.toolBox.setItemText(self.toolBox.indexOf(self.pageFt), f'Token（{self.ft_model.rowCount()}）' if self.ft_model.rowCount() else 'Token')
+            self.toolBox.setItemText(self.toolBox.indexOf(self.pageFt), f'Token（{len(self.ft_model.fts)}）' if self.ft_model.fts else 'Token')
         self.network_status_updated.emit(fts is not None)
 
     def ft_send_button_clicked(self):
-        dialog = SendFtUi(self.password, self.fts_selected()[0], self.key, self.unspent_model.unspents)
+        dialog = SendFtUi(self.password, self.fts_selected()[0], self.private_key(), self.unspents() if self.unspents_refreshed else [])
         if dialog.exec():
             self.tableViewFt.clearSelection()
             self.refresh_button_clicked()
 
+    def private_key(self) -> Optional[Key]:
+        """Private key of the FT address, HD wallet derives it only when needed"""
+        if type(self.xkey) is Xprv:
+            return self.xkey.ckd(0).ckd(0).private_key()
+        return self.key
+
     def fts_selected(self) -> List[Dict]:
-        fts: List[Dict] = []
-        for row in set(index.row() for index in self.tableViewFt.selectedIndexes()):
-            fts.append(self.ft_model.fts[row])
-        return fts
+        rows = set(index.row() for index in self.tableViewFt.selectedIndexes())
+        return [self.ft_model.fts[row] for row in self.ft_model.source_rows(rows)]
 
     def update_fields(self, app_settings: Optional[Dict] = None, password: Optional[str] = None, w: Optional[Dict] = None):
         if app_settings is not None:
             self.app_settings = app_settings
-            self.refresh_unspent_thread.update_fields(self.app_settings['client_key'])
-            self.refresh_ft_thread.update_fields(self.app_settings['client_key'])
-            self.refresh_button_clicked()
+            self.refresh_unspent_job.update_fields(self.app_settings['client_key'])
+            self.refresh_ft_job.update_fields(self.app_settings['client_key'])
+            if self.discover_job:
+                self.discover_job.update_fields(self.app_settings['client_key'])
         if password is not None:
             self.password = password
             if self.keys_widget:
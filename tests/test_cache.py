@@ -0,0 +1,40 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+
+from mvclib.constants import Chain
+
+from cache import UnspentCache
+from store import UnspentStore
+
+ADDRESS = 'mpXwg4jMtRhuSpVq4xS3HFHmCmWp9NyGKt'
+
+
+def unspent(i: int, height: int) -> dict:
+    return {'txid': f'{i:064x}', 'vout': i % 3, 'satoshi': 1000 + i, 'height': height, 'address': ADDRESS}
+
+
+def unspents(indexes) -> UnspentStore:
+    return UnspentStore.from_dicts([unspent(i, i) for i in indexes])
+
+
+def test_merge_writes_the_difference(tmp_path):
+    file = str(tmp_path / 'a.cache')
+    cache = UnspentCache(file)
+    assert cache.merge('w', Chain.TEST, unspents(range(100))) == (100, 0)
+    assert cache.merge('w', Chain.TEST, unspents(range(100))) == (0, 0)
+    # 3 spent, 2 received, and the heights of the others changed
+    refreshed = UnspentStore.from_dicts([unspent(i, i + 1) for i in range(3, 100)] + [unspent(i, -1) for i in (100, 101)])
+    assert cache.merge('w', Chain.TEST, refreshed) == (2, 3)
+    cache.close()
+    assert sorted(UnspentCache(file).load('w', Chain.TEST).records()) == sorted(refreshed.records())
+
+
+def test_merge_loads_the_cache_first(tmp_path):
+    file = str(tmp_path / 'a.cache')
+    UnspentCache(file).merge('w', Chain.TEST, unspents(range(10)))
+    cache = UnspentCache(file)
+    assert cache.merge('w', Chain.TEST, unspents(range(1, 10))) == (0, 1)
+    assert cache.merge('other', Chain.TEST, unspents(range(5))) == (5, 0)
+    assert len(cache.load('w', Chain.TEST)) == 9
@@ -0,0 +1,98 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+
+import pytest
+from PyQt6.QtWidgets import QApplication, QTableView
+
+from mvclib.constants import Chain
+from mvclib.hd import Xprv
+
+from base import UnspentModel, FtModel
+from cache import KeyCache
+from derivation import derive_keys
+from keys import XkeyModel, KeysUi
+from store import UnspentStore
+
+ADDRESS = 'mpXwg4jMtRhuSpVq4xS3HFHmCmWp9NyGKt'
+
+
+@pytest.fixture(scope='module')
+def app():
+    return QApplication.instance() or QApplication([])
+
+
+def unspent_store() -> UnspentStore:
+    return UnspentStore.from_dicts([{'txid': f'{i:064x}', 'vout': i % 2, 'satoshi': 1000 + i, 'height': i, 'address': ADDRESS} for i in range(10)])
+
+
+def fts():
+    return [{'codeHash': 'ab', 'genesis': f'{i:02x}', 'symbol': f'T{i}', 'name': 'Token', 'utxoCount': 1, 'confirmedString': '10', 'unconfirmedString': '0', 'decimal': 2}
+            for i in range(3)]
+
+
+@pytest.mark.parametrize('model', [lambda: UnspentModel(unspent_store()), lambda: FtModel(fts())])
+def test_keyboard_search(app, model):
+    view = QTableView()
+    view.setModel(model())
+    view.setCurrentIndex(view.model().index(0, 0))
+    view.keyboardSearch('a')
+    view.keyboardSearch('1')
+
+
+def test_unspent_refresh_by_difference(app):
+    store = unspent_store()
+    model = UnspentModel(store)
+    model.sort(0)
+    removed = []
+    model.rowsRemoved.connect(lambda _, first, last: removed.append((first, last)))
+    model.update_fields(store.select(list(range(1, 10))))
+    assert removed == [(0, 0)]
+    assert model.rowCount() == 9
+    assert model.data(model.index(0, 0), 0) == '1'
+
+
+def xkey_model(limit: int = 30) -> XkeyModel:
+    xpub = Xprv.from_seed(b'1' * 64, Chain.TEST).xpub()
+    key_cache = KeyCache(tempfile.mktemp(), 'password')
+    keys = derive_keys(xpub, 0, limit)
+    key_cache.extend(xpub, 0, 0, keys)
+    unspents = UnspentStore.from_dicts([{'txid': f'{i:064x}', 'vout': 0, 'satoshi': 1000, 'height': 1, 'address': keys[i % 3].address} for i in range(6)])
+    return XkeyModel(xpub, key_cache, 0, limit, unspents)
+
+
+def test_xkey_keyboard_search(app):
+    view = QTableView()
+    view.setModel(xkey_model())
+    view.setCurrentIndex(view.model().index(0, 0))
+    view.keyboardSearch('a')
+
+
+def test_xkey_selection_does_not_format_rows(app):
+    model = xkey_model()
+    rows = set(range(model.rowCount()))
+    assert model.unspents_count(rows) == 6
+    assert model.unspents_count({1}) == 2
+    store, _ = model.unspents_of({0, 5}, model.xpub)
+    assert len(store) == 2
+    assert not model.row_cache
+    model.search(next(iter(model.address_index))[-6:])
+    assert model.unspents_count({0}) == 2
+
+
+def test_keys_send_waits_for_the_network_refresh(app):
+    model = xkey_model()
+    w = {'name': 'wallet', 'xprv': str(Xprv.from_seed(b'1' * 64, Chain.TEST)), 'receive_index': 0, 'receive_limit': 30, 'change_limit': 30}
+    keys = KeysUi('password', w, model.key_cache, unspents=model.unspents)
+    try:
+        keys.tableViewReceive.selectAll()
+        assert not keys.pushButtonReceiveSend.isEnabled()
+        keys.update_fields(unspents=model.unspents, unspents_refreshed=True)
+        keys.tableViewReceive.selectAll()
+        assert keys.pushButtonReceiveSend.isEnabled()
+    finally:
+        keys.stop_derivation()
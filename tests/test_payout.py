@@ -0,0 +1,26 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+
+import pytest
+
+from payout import PayoutPlans
+
+
+def test_plans_are_copied_in_and_out(tmp_path):
+    plans = PayoutPlans(str(tmp_path / 'a.payouts'), 'password')
+    plan = {'receivers': 2000, 'transactions': ['00', '01', '02'], 'txids': ['a', 'b', 'c'], 'broadcast': 0}
+    plans.put('wallet', plan)
+    plan['broadcast'] = 2
+    assert plans.plan('wallet')['broadcast'] == 0
+    assert PayoutPlans(plans.file, 'password').plan('wallet')['broadcast'] == 0
+
+
+def test_password_is_kept_if_plans_cannot_be_saved(tmp_path):
+    plans = PayoutPlans(str(tmp_path / 'a.payouts'), 'password')
+    plans.put('wallet', {'broadcast': 0})
+    plans.file = str(tmp_path / 'missing' / 'a.payouts')
+    with pytest.raises(OSError):
+        plans.update_fields('changed')
+    assert plans.password == 'password'